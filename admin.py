@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import logging
-from datetime import datetime, timezone
+from datetime import date, datetime, timedelta
 from aiogram import Router
 from aiogram.types import Message
 from aiogram.filters import Command
@@ -11,9 +11,13 @@ from db import (
     add_channel, remove_channel, list_channels,
     inc_points, set_banned,
     add_resource, remove_resource, list_resources,
-    reset_all_stuck_resources,
-    get_user, db
+    reset_all_stuck_resources, get_counters,
+    get_user, log_admin_action, db
 )
+from ai import model_health, ai_cache_stats, flush_ai_cache, governor
+from broadcast import parse_segment, segment_query, describe_segment
+from join_gate import refresh_required_cache
+from stats import get_stats_snapshot, daily_range, cached_user_count
 
 log = logging.getLogger("earnova")
 router = Router()
@@ -42,6 +46,7 @@ async def admin_help(m: Message):
         "━━━━━━━━━━━━━━━━━━━━━\n\n"
         "📊 STATS\n"
         "/stats — bot statistics\n"
+        "/stats_range [days] — daily rollups (or [from] [to] as YYYY-MM-DD)\n"
         "/res_list — list all accounts\n"
         "/ch_list — list required channels\n\n"
         "👤 USER MANAGEMENT\n"
@@ -52,7 +57,9 @@ async def admin_help(m: Message):
         "/points_take [user_id] [pts] — remove points\n"
         "/msg [user_id] [text] — DM a user\n\n"
         "🔍 DEBUG\n"
-        "/debug_db — raw DB dump of all accounts\n\n"
+        "/debug_db — raw DB dump of all accounts\n"
+        "/ai_status — AI model health, cache and queue stats\n"
+        "/ai_cache_flush — clear cached AI answers\n\n"
         "📦 ACCOUNT MANAGEMENT\n"
         "/res_add [name] | [secret] — add account\n"
         "  (optional: | [cost] | [1 if default])\n"
@@ -63,6 +70,10 @@ async def admin_help(m: Message):
         "/ch_remove [channel_id] — remove channel\n\n"
         "📣 BROADCAST\n"
         "/broadcast [text] — send to all users\n"
+        "/broadcast [filters] | [text] — send to a segment\n"
+        "  (filters: lang=en active=7d min_points=10 banned=no referrers;\n"
+        "   reply to any message to broadcast a copy of it)\n"
+        "/broadcast_status — progress of the latest broadcast\n"
         "━━━━━━━━━━━━━━━━━━━━━",
         parse_mode=None,
     )
@@ -74,32 +85,74 @@ async def admin_help(m: Message):
 async def stats(m: Message):
     if await deny(m):
         return
-    users = await db.users.count_documents({})
-    banned = await db.users.count_documents({"banned": True})
-    avail = await db.resources.count_documents({"status": "available"})
-    assigned = await db.resources.count_documents({"status": "assigned"})
-    total_res = await db.resources.count_documents({})
-    channels = await db.channels.count_documents({})
-    pending = await db.proofs.count_documents({"status": "pending"})
-    ai_chats = await db.ai_logs.count_documents({})
-
-    today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    new_today = await db.users.count_documents({"created_at": {"$gte": today_start}})
-
+    st = await get_stats_snapshot()
     await m.reply(
         "━━━━━━━━━━━━━━━━━━━━━\n"
         "📊 BOT STATS\n"
         "━━━━━━━━━━━━━━━━━━━━━\n"
-        f"👥 Total users: {users}\n"
-        f"🚫 Banned users: {banned}\n"
-        f"🆕 New today: {new_today}\n\n"
-        f"📦 Accounts total: {total_res}\n"
-        f"  ✅ Available: {avail}\n"
-        f"  🔒 Assigned: {assigned}\n\n"
-        f"📢 Required channels: {channels + 1}\n"
-        f"⏳ Pending proofs: {pending}\n"
-        f"🤖 AI chats logged: {ai_chats}\n"
-        "━━━━━━━━━━━━━━━━━━━━━",
+        f"👥 Total users: {st['users']}\n"
+        f"🚫 Banned users: {st['banned']}\n"
+        f"🆕 New today: {st['new_today']}\n\n"
+        f"📦 Accounts total: {st['resources_total']}\n"
+        f"  ✅ Available: {st['resources_available']}\n"
+        f"  🔒 Assigned: {st['resources_assigned']}\n\n"
+        f"📢 Required channels: {st['channels'] + 1}\n"
+        f"⏳ Pending proofs: {st['proofs_pending']}\n"
+        f"🤖 AI chats logged: {st['ai_chats']}\n"
+        "━━━━━━━━━━━━━━━━━━━━━\n"
+        f"As of {st['computed_at']:%H:%M:%S} UTC",
+        parse_mode=None,
+    )
+
+
+STATS_RANGE_MAX_DAYS = 3660
+# Per-day lines shown in one reply (Telegram caps a message at 4096 chars); totals cover the whole range
+STATS_RANGE_MAX_LINES = 60
+
+
+@router.message(Command("stats_range"))
+async def stats_range(m: Message):
+    if await deny(m):
+        return
+    parts = (m.text or "").split()
+    today = datetime.utcnow().date()
+    try:
+        if len(parts) == 1:
+            start, end = today - timedelta(days=6), today
+        elif len(parts) == 2:
+            days = int(parts[1])
+            if not 1 <= days <= STATS_RANGE_MAX_DAYS:
+                raise ValueError
+            start, end = today - timedelta(days=days - 1), today
+        elif len(parts) == 3:
+            start, end = date.fromisoformat(parts[1]), date.fromisoformat(parts[2])
+        else:
+            raise ValueError
+    except (ValueError, OverflowError):
+        await m.reply(
+            f"Usage: /stats_range [days, max {STATS_RANGE_MAX_DAYS}] or /stats_range [YYYY-MM-DD] [YYYY-MM-DD]",
+            parse_mode=None,
+        )
+        return
+
+    rows = await daily_range(start.isoformat(), end.isoformat())
+    keys = ("new_users", "claims", "proofs", "expiries", "bans")
+    totals = {k: sum(int(r.get(k, 0)) for r in rows) for k in keys}
+    lines = [
+        f"{r['_id']}: 🆕{r.get('new_users', 0)} 📦{r.get('claims', 0)} "
+        f"📸{r.get('proofs', 0)} ⌛{r.get('expiries', 0)} 🚫{r.get('bans', 0)}"
+        for r in rows[-STATS_RANGE_MAX_LINES:]
+    ]
+    if len(rows) > STATS_RANGE_MAX_LINES:
+        lines.insert(0, f"… {len(rows) - STATS_RANGE_MAX_LINES} earlier days not listed")
+    await m.reply(
+        f"📈 Daily stats {start} → {end}\n"
+        "(🆕 new users, 📦 claims, 📸 proofs, ⌛ expiries, 🚫 bans)\n"
+        "━━━━━━━━━━━━\n"
+        + ("\n".join(lines) or "No data in range.")
+        + "\n━━━━━━━━━━━━\n"
+        f"Total: 🆕{totals['new_users']} 📦{totals['claims']} 📸{totals['proofs']} "
+        f"⌛{totals['expiries']} 🚫{totals['bans']}",
         parse_mode=None,
     )
 
@@ -151,7 +204,7 @@ async def ban(m: Message):
         await m.reply("Invalid user_id", parse_mode=None)
         return
     await set_banned(uid, True)
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "ban", "payload": {"uid": uid}, "ts": datetime.utcnow()})
+    log_admin_action(m.from_user.id, "ban", {"uid": uid})
     await m.reply(f"🚫 Banned user {uid}", parse_mode=None)
 
 
@@ -169,7 +222,7 @@ async def unban(m: Message):
         await m.reply("Invalid user_id", parse_mode=None)
         return
     await set_banned(uid, False)
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "unban", "payload": {"uid": uid}, "ts": datetime.utcnow()})
+    log_admin_action(m.from_user.id, "unban", {"uid": uid})
     await m.reply(f"✅ Unbanned user {uid}", parse_mode=None)
 
 
@@ -188,7 +241,7 @@ async def points_give(m: Message):
         await m.reply("Invalid numbers", parse_mode=None)
         return
     await inc_points(uid, pts)
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "points_give", "payload": {"uid": uid, "pts": pts}, "ts": datetime.utcnow()})
+    log_admin_action(m.from_user.id, "points_give", {"uid": uid, "pts": pts})
     await m.reply(f"✅ Gave {pts} points to user {uid}", parse_mode=None)
 
 
@@ -207,7 +260,7 @@ async def points_take(m: Message):
         await m.reply("Invalid numbers", parse_mode=None)
         return
     await inc_points(uid, -abs(pts))
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "points_take", "payload": {"uid": uid, "pts": pts}, "ts": datetime.utcnow()})
+    log_admin_action(m.from_user.id, "points_take", {"uid": uid, "pts": pts})
     await m.reply(f"✅ Took {pts} points from user {uid}", parse_mode=None)
 
 
@@ -238,9 +291,10 @@ async def msg_user(m: Message):
 async def debug_db(m: Message):
     if await deny(m):
         return
-    total = await db.resources.count_documents({})
-    avail = await db.resources.count_documents({"status": "available"})
-    assigned = await db.resources.count_documents({"status": "assigned"})
+    counters = await get_counters()
+    total = counters.get("resources_total", 0)
+    avail = counters.get("resources_available", 0)
+    assigned = counters.get("resources_assigned", 0)
     other = total - avail - assigned
 
     lines = [f"DB DUMP — resources (total={total})\navailable={avail} assigned={assigned} other={other}\n"]
@@ -257,6 +311,40 @@ async def debug_db(m: Message):
     await m.reply("\n\n".join(lines), parse_mode=None)
 
 
+@router.message(Command("ai_status"))
+async def ai_status(m: Message):
+    if await deny(m):
+        return
+    lines = []
+    for h in model_health():
+        state = f"⛔ open {int(h['open_for'])}s" if h["open_for"] else "✅ ok"
+        lat = f"{h['latency']:.1f}s" if h["latency"] is not None else "n/a"
+        lines.append(f"{h['model']}\n  {state}, latency {lat}, failures {h['failures']}")
+    c = ai_cache_stats()
+    lines.append(
+        "━━━━━━━━━━━━\n"
+        f"💾 Cache: {c['size']} entries, hit rate {c['hit_rate']:.0%}\n"
+        f"  hits {c['hits']} (+{c['redis_hits']} redis), misses {c['misses']}"
+    )
+    g = governor.metrics()
+    lines.append(
+        f"🚦 Running {g['running']}/{g['limit']}, queued {g['queued']}/{g['queue_max']}\n"
+        f"  admitted {g['admitted']}, wait avg {g['wait_avg']:.2f}s p90 {g['wait_p90']:.2f}s\n"
+        f"  rejected: busy {g['rejected']['busy']}, timeout {g['rejected']['timeout']}, "
+        f"in-flight {g['rejected']['in_flight']}"
+    )
+    await m.reply("🤖 AI models (best first)\n━━━━━━━━━━━━\n" + "\n".join(lines), parse_mode=None)
+
+
+@router.message(Command("ai_cache_flush"))
+async def ai_cache_flush(m: Message):
+    if await deny(m):
+        return
+    removed = await flush_ai_cache()
+    log_admin_action(m.from_user.id, "ai_cache_flush", {"redis_keys": removed})
+    await m.reply(f"✅ AI cache flushed ({removed} shared entries removed).", parse_mode=None)
+
+
 @router.message(Command("res_add"))
 async def res_add(m: Message):
     if await deny(m):
@@ -280,7 +368,7 @@ async def res_add(m: Message):
     cost = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else 0
     default_flag = bool(int(parts[3])) if len(parts) >= 4 and parts[3].isdigit() else False
     rid = await add_resource(name, secret, cost=cost, default_flag=default_flag)
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "res_add", "payload": {"rid": str(rid), "name": name}, "ts": datetime.utcnow()})
+    log_admin_action(m.from_user.id, "res_add", {"rid": str(rid), "name": name})
     await m.reply(
         f"✅ Account added!\nName: {name}\nCost: {cost} pts\nDefault: {default_flag}\nID: {rid}",
         parse_mode=None,
@@ -296,7 +384,7 @@ async def res_remove(m: Message):
         await m.reply("Usage: /res_remove [account_id]\n(Copy ID from /res_list)", parse_mode=None)
         return
     ok = await remove_resource(parts[1].strip())
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "res_remove", "payload": {"rid": parts[1].strip(), "ok": ok}, "ts": datetime.utcnow()})
+    log_admin_action(m.from_user.id, "res_remove", {"rid": parts[1].strip(), "ok": ok})
     await m.reply("✅ Account removed" if ok else "❌ Invalid ID — check /res_list for correct ID", parse_mode=None)
 
 
@@ -305,8 +393,9 @@ async def res_list(m: Message):
     if await deny(m):
         return
     rs = await list_resources(30)
-    avail = await db.resources.count_documents({"status": "available"})
-    assigned = await db.resources.count_documents({"status": "assigned"})
+    counters = await get_counters()
+    avail = counters.get("resources_available", 0)
+    assigned = counters.get("resources_assigned", 0)
     if not rs:
         await m.reply("No accounts in database.\nAdd one with /res_add", parse_mode=None)
         return
@@ -351,7 +440,8 @@ async def ch_add(m: Message):
         await m.reply("Only supported type: required", parse_mode=None)
         return
     await add_channel(cid, ch_type)
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "ch_add", "payload": {"cid": cid, "type": ch_type}, "ts": datetime.utcnow()})
+    await refresh_required_cache(force=True)
+    log_admin_action(m.from_user.id, "ch_add", {"cid": cid, "type": ch_type})
     await m.reply(f"✅ Channel {cid} added as required.\nAll users must now join it to use the bot.", parse_mode=None)
 
 
@@ -369,7 +459,8 @@ async def ch_remove(m: Message):
         await m.reply("Invalid channel_id", parse_mode=None)
         return
     await remove_channel(cid)
-    await db.admin_actions.insert_one({"admin_id": int(m.from_user.id), "action": "ch_remove", "payload": {"cid": cid}, "ts": datetime.utcnow()})
+    await refresh_required_cache(force=True)
+    log_admin_action(m.from_user.id, "ch_remove", {"cid": cid})
     await m.reply(f"✅ Channel {cid} removed.", parse_mode=None)
 
 
@@ -390,11 +481,68 @@ async def ch_list(m: Message):
 async def broadcast(m: Message):
     if await deny(m):
         return
+    usage = (
+        "Usage:\n"
+        "/broadcast [text] — send text to all users\n"
+        "/broadcast [filters] | [text] — send text to a segment\n"
+        "Reply to any message with /broadcast [filters] — copy it to a segment\n\n"
+        "Filters: lang=bn|en active=7d min_points=10 banned=yes|no referrers\n\n"
+        "Example: /broadcast lang=en active=7d | Hello everyone!"
+    )
     parts = (m.text or "").split(maxsplit=1)
-    if len(parts) != 2 or not parts[1].strip():
-        await m.reply("Usage: /broadcast [text]\n\nExample: /broadcast Hello everyone!", parse_mode=None)
+    args = parts[1].strip() if len(parts) == 2 else ""
+    src = m.reply_to_message
+
+    text = None
+    seg: dict = {}
+    if src:
+        try:
+            seg = parse_segment(args.split())
+        except ValueError as e:
+            await m.reply(f"❌ {e}\n\n{usage}", parse_mode=None)
+            return
+    elif "|" in args:
+        filters, _, rest = args.partition("|")
+        try:
+            seg, text = parse_segment(filters.split()), rest.strip()
+        except ValueError:
+            # Not a filter list, so the "|" is just part of the message
+            text = args
+    else:
+        text = args
+    if not src and not text:
+        await m.reply(usage, parse_mode=None)
+        return
+
+    now = datetime.utcnow()
+    # Whole-audience broadcasts use the cached total; segments are narrow indexed counts
+    user_count = await cached_user_count() if not seg else await db.users.count_documents(segment_query(seg, now))
+    job = {"text": text, "segment": seg, "created_at": now, "status": "queued", "sent": 0, "failed": 0}
+    if src:
+        job["copy_from"] = {"chat_id": src.chat.id, "message_id": src.message_id}
+    await db.broadcast_jobs.insert_one(job)
+    await m.reply(
+        f"✅ Broadcast queued for {user_count} users ({describe_segment(seg)}).\n"
+        "It will be sent gradually to avoid Telegram limits.",
+        parse_mode=None,
+    )
+
+
+@router.message(Command("broadcast_status"))
+async def broadcast_status(m: Message):
+    if await deny(m):
+        return
+    job = await db.broadcast_jobs.find_one({}, sort=[("created_at", -1)])
+    if not job:
+        await m.reply("No broadcasts yet.", parse_mode=None)
         return
-    text = parts[1].strip()
-    user_count = await db.users.count_documents({})
-    await db.broadcast_jobs.insert_one({"text": text, "created_at": datetime.utcnow(), "status": "queued", "sent": 0, "failed": 0})
-    await m.reply(f"✅ Broadcast queued for {user_count} users.\nIt will be sent gradually to avoid Telegram limits.", parse_mode=None)
+    await m.reply(
+        f"📣 Latest broadcast: {job['_id']}\n"
+        f"Segment: {describe_segment(job.get('segment') or {})}\n"
+        f"Status: {job.get('status')}\n"
+        f"Sent: {job.get('sent', 0)}\n"
+        f"Failed: {job.get('failed', 0)} (unreachable: {job.get('unreachable', 0)})\n"
+        f"Last user_id: {job.get('last_user_id', 0)}\n"
+        f"Updated: {job.get('progress_at', 'N/A')}",
+        parse_mode=None,
+    )
@@ -1,7 +1,17 @@
 from __future__ import annotations
+import asyncio
+import hashlib
+import importlib.util
+import json
 import logging
+import time
+from collections import deque
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set
 import httpx
+from cache import TTLCache
 from config import settings
+from rate_limit import async_redis_client
 
 log = logging.getLogger("earnova")
 
@@ -15,49 +25,473 @@ FALLBACK_MODELS = [
     "meta-llama/llama-3-8b-instruct:free",
 ]
 
-async def ask_ai(user_text: str, lang: str = "bn") -> str:
-    if not settings.OPENROUTER_API_KEY:
-        return "AI feature is disabled (OPENROUTER_API_KEY not set)."
+UNAVAILABLE = "AI is currently unavailable. Please try again later."
+BUSY = "AI is busy right now. Please try again in a minute."
+IN_FLIGHT = "Please wait, I'm still answering your previous question."
 
-    if lang == "en":
-        system_prompt = "You are a helpful assistant. Always reply in English. Be concise."
-    else:
-        system_prompt = (
-            "You are a helpful assistant. "
-            "If the user writes in Bangla, reply in Bangla. "
-            "Otherwise reply in English. Be concise."
+# HTTP/2 needs the optional `h2` package (httpx[http2]); plain keep-alive otherwise
+_HTTP2 = importlib.util.find_spec("h2") is not None
+_client: Optional[httpx.AsyncClient] = None
+
+
+async def start_ai_client():
+    """One pooled, keep-alive client for the whole process (created at startup)."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=_HTTP2,
+            timeout=httpx.Timeout(settings.AI_TIMEOUT_SEC, connect=5),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+            headers={
+                "Authorization": f"Bearer {settings.OPENROUTER_API_KEY}",
+                "Content-Type": "application/json",
+                "HTTP-Referer": "https://earnova-bot.replit.app",
+                "X-Title": "Earnova Bot",
+            },
         )
 
-    headers = {
-        "Authorization": f"Bearer {settings.OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://earnova-bot.replit.app",
-        "X-Title": "Earnova Bot",
+
+async def close_ai_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _http() -> httpx.AsyncClient:
+    if _client is None:
+        await start_ai_client()
+    return _client
+
+
+class ModelHealth:
+    """
+    Per-model circuit breaker plus a latency EWMA used for ranking.
+    After AI_BREAKER_THRESHOLD consecutive failures the model is skipped for a
+    cooldown that doubles on each further failure; a 404 (model gone) opens it
+    for AI_NOT_FOUND_COOLDOWN_SEC straight away. Once the cooldown passes the
+    next request is a trial: success closes the breaker, failure re-opens it.
+    """
+
+    def __init__(self, model: str, rank: int):
+        self.model = model
+        self.rank = rank
+        self.failures = 0
+        self.open_until = 0.0
+        self.latency: Optional[float] = None
+        self.samples: deque = deque(maxlen=50)
+
+    def available(self, now: float) -> bool:
+        return now >= self.open_until
+
+    def record_success(self, latency: float):
+        self.failures = 0
+        self.open_until = 0.0
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        self.samples.append(latency)
+
+    def p90(self) -> Optional[float]:
+        if len(self.samples) < 5:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * 0.9) - 1]
+
+    def record_failure(self, status: Optional[int] = None):
+        self.failures += 1
+        now = time.monotonic()
+        if status == 404:
+            self.open_until = now + settings.AI_NOT_FOUND_COOLDOWN_SEC
+        elif self.failures >= settings.AI_BREAKER_THRESHOLD:
+            extra = min(self.failures - settings.AI_BREAKER_THRESHOLD, 5)
+            self.open_until = now + settings.AI_BREAKER_COOLDOWN_SEC * (2 ** extra)
+
+    def score(self) -> tuple:
+        # Known latency wins; untried models sit at the timeout midpoint, in list order
+        return (self.latency if self.latency is not None else settings.AI_TIMEOUT_SEC / 2, self.rank)
+
+
+_health: Dict[str, ModelHealth] = {m: ModelHealth(m, i) for i, m in enumerate(FALLBACK_MODELS)}
+
+
+def ranked_models() -> List[str]:
+    """Healthy models fastest first; if every breaker is open, one trial of the soonest to recover."""
+    now = time.monotonic()
+    healthy = sorted((h for h in _health.values() if h.available(now)), key=ModelHealth.score)
+    if healthy:
+        return [h.model for h in healthy]
+    return [min(_health.values(), key=lambda h: h.open_until).model]
+
+
+def model_health() -> List[dict]:
+    now = time.monotonic()
+    return [
+        {
+            "model": h.model,
+            "open_for": max(h.open_until - now, 0),
+            "failures": h.failures,
+            "latency": h.latency,
+        }
+        for h in sorted(_health.values(), key=ModelHealth.score)
+    ]
+
+
+def _system_prompt(lang: str) -> str:
+    if lang == "en":
+        return "You are a helpful assistant. Always reply in English. Be concise."
+    return (
+        "You are a helpful assistant. "
+        "If the user writes in Bangla, reply in Bangla. "
+        "Otherwise reply in English. Be concise."
+    )
+
+
+def _payload(model: str, user_text: str, lang: str) -> dict:
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": _system_prompt(lang)},
+            {"role": "user", "content": user_text},
+        ],
+        "temperature": 0.4,
     }
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        for model in FALLBACK_MODELS:
-            payload = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_text},
-                ],
-                "temperature": 0.4,
-            }
+
+async def _ask_model(model: str, user_text: str, lang: str) -> Optional[str]:
+    h = _health[model]
+    t0 = time.monotonic()
+    try:
+        client = await _http()
+        r = await client.post(OPENROUTER_API_URL, json=_payload(model, user_text, lang))
+    except Exception as e:
+        h.record_failure()
+        log.warning(f"OpenRouter request failed for model {model}: {e}")
+        return None
+    if r.status_code == 200:
+        try:
+            answer = r.json()["choices"][0]["message"]["content"].strip()
+        except Exception as e:
+            h.record_failure()
+            log.warning(f"OpenRouter bad response for model {model}: {e}")
+            return None
+        h.record_success(time.monotonic() - t0)
+        return answer
+    h.record_failure(r.status_code)
+    if r.status_code == 404:
+        log.warning(f"OpenRouter model not found: {model}, skipping it for a while")
+    else:
+        log.warning(f"OpenRouter error {r.status_code} for model {model}: {r.text[:200]}")
+    return None
+
+
+async def _stream_model(model: str, user_text: str, lang: str, deadline: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    Yield content deltas from OpenRouter's SSE stream. A failure before the first
+    token ends quietly (caller moves on to the next model); a failure mid-stream
+    is re-raised so the caller knows the text it has is partial. Waiting on
+    upstream past `deadline` (event-loop time) counts as a failure.
+    """
+    h = _health[model]
+    t0 = time.monotonic()
+    got_any = False
+    try:
+        async with asyncio.timeout_at(deadline) as limit:
+            client = await _http()
+            async with client.stream("POST", OPENROUTER_API_URL, json={**_payload(model, user_text, lang), "stream": True}) as r:
+                if r.status_code != 200:
+                    body = (await r.aread())[:200]
+                    h.record_failure(r.status_code)
+                    log.warning(f"OpenRouter stream error {r.status_code} for model {model}: {body!r}")
+                    return
+                async for line in r.aiter_lines():
+                    # SSE: "data: {...}" events, ": keep-alive" comments, "data: [DONE]" at the end
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        delta = json.loads(data)["choices"][0].get("delta", {}).get("content") or ""
+                    except Exception:
+                        continue
+                    if delta:
+                        got_any = True
+                        # The deadline only covers upstream waits, never the caller's work
+                        # between deltas (a timeout there would cancel the caller's awaits)
+                        limit.reschedule(None)
+                        yield delta
+                        limit.reschedule(deadline)
+    except Exception as e:
+        h.record_failure()
+        log.warning(f"OpenRouter stream failed for model {model}: {e!r}")
+        if got_any:
+            raise
+        return
+    if got_any:
+        h.record_success(time.monotonic() - t0)
+    else:
+        h.record_failure()
+
+
+def _hedge_delay(model: str) -> float:
+    """How long to give `model` before racing the next one: configured, else its p90 latency."""
+    if settings.AI_HEDGE_DELAY_SEC is not None:
+        return settings.AI_HEDGE_DELAY_SEC
+    p90 = _health[model].p90()
+    return max(p90, 1.0) if p90 is not None else 4.0
+
+
+async def _race(models: List[str], user_text: str, lang: str, hedge: bool) -> Optional[str]:
+    """
+    Walk `models` best first. A failed model hands over to the next one at once.
+    With `hedge`, a model that is merely slow (past its hedge delay) gets the next
+    one started alongside it, up to AI_HEDGE_MAX_PARALLEL in flight; the first good
+    answer wins and the rest are cancelled. The whole question is bounded by
+    AI_DEADLINE_SEC either way.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.AI_DEADLINE_SEC
+    parallel = settings.AI_HEDGE_MAX_PARALLEL if hedge else 1
+    queue = list(models)
+    running: Dict[asyncio.Task, str] = {}
+
+    def launch():
+        model = queue.pop(0)
+        running[asyncio.create_task(_ask_model(model, user_text, lang))] = model
+
+    try:
+        launch()
+        while running:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                log.warning(f"ask_ai: deadline of {settings.AI_DEADLINE_SEC}s reached")
+                return None
+            timeout = remaining
+            can_hedge = hedge and queue and len(running) < parallel
+            if can_hedge:
+                newest = list(running.values())[-1]
+                timeout = min(timeout, _hedge_delay(newest))
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                running.pop(task)
+                answer = task.result()
+                if answer:
+                    return answer
+            # A failure frees a slot; a slow model past its hedge delay earns a backup
+            if queue and (done or can_hedge) and len(running) < parallel:
+                launch()
+        return None
+    finally:
+        for task in running:
+            task.cancel()
+
+
+# Answer cache: in-process LRU in front of an optional shared Redis tier
+_answer_cache = TTLCache(settings.AI_CACHE_SIZE, settings.AI_CACHE_TTL_SEC)
+_cache_stats = {"hits": 0, "redis_hits": 0, "misses": 0}
+_CACHE_MAX_ANSWER = 4000  # don't spend cache space on outliers
+_CACHE_PREFIX = "ai:"
+
+
+def _cache_key(user_text: str, lang: str) -> str:
+    # Case, whitespace and trailing punctuation don't change the question
+    norm = " ".join(user_text.casefold().split()).rstrip("?!.।؟ ")
+    return f"{lang}:{hashlib.sha1(norm.encode()).hexdigest()}"
+
+
+async def _cache_get(key: str) -> Optional[str]:
+    answer = _answer_cache.get(key)
+    if answer is not None:
+        _cache_stats["hits"] += 1
+        return answer
+    r = async_redis_client()
+    if r:
+        try:
+            answer = await r.get(_CACHE_PREFIX + key)
+        except Exception as e:
+            log.warning(f"ai cache redis get failed: {e}")
+        if answer is not None:
+            _cache_stats["redis_hits"] += 1
+            _answer_cache.set(key, answer)
+            return answer
+    _cache_stats["misses"] += 1
+    return None
+
+
+async def _cache_set(key: str, answer: str):
+    if len(answer) > _CACHE_MAX_ANSWER:
+        return
+    _answer_cache.set(key, answer)
+    r = async_redis_client()
+    if r:
+        try:
+            await r.set(_CACHE_PREFIX + key, answer, ex=settings.AI_CACHE_TTL_SEC)
+        except Exception as e:
+            log.warning(f"ai cache redis set failed: {e}")
+
+
+def ai_cache_stats() -> dict:
+    total = sum(_cache_stats.values())
+    hit = _cache_stats["hits"] + _cache_stats["redis_hits"]
+    return {**_cache_stats, "size": len(_answer_cache), "hit_rate": hit / total if total else 0.0}
+
+
+async def flush_ai_cache() -> int:
+    """Drop every cached answer (this process + Redis). Returns the number of Redis keys removed."""
+    _answer_cache.clear()
+    r = async_redis_client()
+    if not r:
+        return 0
+    removed = 0
+    batch = []
+    async for k in r.scan_iter(match=_CACHE_PREFIX + "*", count=500):
+        batch.append(k)
+        if len(batch) >= 500:
+            removed += await r.unlink(*batch)
+            batch = []
+    if batch:
+        removed += await r.unlink(*batch)
+    return removed
+
+
+class AIBusy(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AIGovernor:
+    """
+    Admission control for upstream AI calls: at most `limit` run at once, at most
+    `queue_max` wait behind them (each for up to `max_wait` seconds), and each user
+    has a single question in flight. Anything beyond that is refused at once with
+    AIBusy instead of piling up outbound connections and webhook handlers.
+    """
+
+    def __init__(self, limit: int, queue_max: int, max_wait: float):
+        self.limit = limit
+        self.queue_max = queue_max
+        self.max_wait = max_wait
+        self._sem = asyncio.Semaphore(limit)
+        self._users: Set[int] = set()
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {"busy": 0, "in_flight": 0, "timeout": 0}
+        self._waits: deque = deque(maxlen=200)
+
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[int]):
+        if user_id is not None and user_id in self._users:
+            self.rejected["in_flight"] += 1
+            raise AIBusy("in_flight")
+        if self.running >= self.limit and self.waiting >= self.queue_max:
+            self.rejected["busy"] += 1
+            raise AIBusy("busy")
+        if user_id is not None:
+            self._users.add(user_id)
+        try:
+            t0 = time.monotonic()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._sem.acquire(), timeout=self.max_wait)
+            except asyncio.TimeoutError:
+                self.rejected["timeout"] += 1
+                raise AIBusy("busy")
+            finally:
+                self.waiting -= 1
+            self._waits.append(time.monotonic() - t0)
+            self.admitted += 1
+            self.running += 1
             try:
-                r = await client.post(OPENROUTER_API_URL, json=payload, headers=headers)
-                if r.status_code == 200:
-                    data = r.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                elif r.status_code == 404:
-                    log.warning(f"OpenRouter model not found: {model}, trying next...")
-                    continue
-                else:
-                    log.warning(f"OpenRouter error {r.status_code} for model {model}: {r.text[:200]}")
-                    continue
-            except Exception as e:
-                log.warning(f"OpenRouter request failed for model {model}: {e}")
-                continue
-
-    return "AI is currently unavailable. Please try again later."
+                yield
+            finally:
+                self.running -= 1
+                self._sem.release()
+        finally:
+            self._users.discard(user_id)
+
+    def metrics(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "running": self.running,
+            "limit": self.limit,
+            "queued": self.waiting,
+            "queue_max": self.queue_max,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p90": waits[max(int(len(waits) * 0.9) - 1, 0)] if waits else 0.0,
+        }
+
+
+governor = AIGovernor(settings.AI_MAX_CONCURRENCY, settings.AI_QUEUE_MAX, settings.AI_QUEUE_WAIT_SEC)
+
+
+async def ask_ai(user_text: str, lang: str = "bn", user_id: Optional[int] = None) -> str:
+    if not settings.OPENROUTER_API_KEY:
+        return "AI feature is disabled (OPENROUTER_API_KEY not set)."
+
+    key = _cache_key(user_text, lang)
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        async with governor.slot(user_id):
+            answer = await _race(ranked_models(), user_text, lang, hedge=settings.AI_HEDGE_ENABLED)
+    except AIBusy as e:
+        return IN_FLIGHT if e.reason == "in_flight" else BUSY
+    if not answer:
+        return UNAVAILABLE
+    await _cache_set(key, answer)
+    return answer
+
+
+async def ask_ai_stream(user_text: str, lang: str = "bn", user_id: Optional[int] = None) -> AsyncIterator[str]:
+    """
+    Like ask_ai, but yields the answer so far (cumulative text) as tokens arrive.
+    Models are tried in rank order until one produces output; once text has been
+    shown it is never restarted on another model. Only complete answers are cached.
+    """
+    if not settings.OPENROUTER_API_KEY:
+        yield "AI feature is disabled (OPENROUTER_API_KEY not set)."
+        return
+
+    key = _cache_key(user_text, lang)
+    cached = await _cache_get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    text = ""
+    complete = False
+    try:
+        async with governor.slot(user_id):
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + settings.AI_DEADLINE_SEC
+            for model in ranked_models():
+                if loop.time() >= deadline:
+                    break
+                try:
+                    async with aclosing(_stream_model(model, user_text, lang, deadline)) as stream:
+                        async for delta in stream:
+                            text += delta
+                            yield text
+                            if loop.time() >= deadline:
+                                log.warning(f"ask_ai_stream: deadline of {settings.AI_DEADLINE_SEC}s reached")
+                                break
+                        else:
+                            complete = bool(text)
+                except Exception:
+                    pass  # mid-stream failure: keep the partial text
+                if text:
+                    break
+    except AIBusy as e:
+        yield IN_FLIGHT if e.reason == "in_flight" else BUSY
+        return
+
+    if not text:
+        yield UNAVAILABLE
+        return
+    if complete:
+        await _cache_set(key, text.strip())
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta
+
+from cache import TTLCache
+from config import settings
+from db import set_ai_mode_until, get_ai_mode_until, active_ai_modes
+from rate_limit import async_redis_client
+
+log = logging.getLogger("earnova")
+
+# {user_id: True} for users currently in AI mode; the entry's TTL is the remaining window.
+# Every text message checks this. With Redis the common "not in AI mode" answer never
+# reaches Mongo; without it another worker process may have opened the window, so
+# misses fall back to ai_state behind a short negative cache.
+_active = TTLCache(settings.AI_MODE_CACHE_SIZE, settings.AI_MODE_SEC)
+_inactive = TTLCache(settings.AI_MODE_CACHE_SIZE, settings.AI_MODE_NEGATIVE_TTL_SEC)
+
+
+def _redis_key(user_id: int) -> str:
+    return f"aim:{int(user_id)}"
+
+
+async def enable_ai_mode(user_id: int):
+    _inactive.pop(int(user_id))
+    _active.set(int(user_id), True, settings.AI_MODE_SEC)
+    r = async_redis_client()
+    if r:
+        try:
+            await r.set(_redis_key(user_id), "1", ex=settings.AI_MODE_SEC)
+        except Exception as e:
+            log.warning(f"ai mode redis set failed: {e}")
+    await set_ai_mode_until(user_id, datetime.utcnow() + timedelta(seconds=settings.AI_MODE_SEC))
+
+
+async def in_ai_mode(user_id: int) -> bool:
+    if int(user_id) in _active:
+        return True
+    r = async_redis_client()
+    if not r:
+        return await _in_ai_mode_db(int(user_id))
+    try:
+        # One round-trip answers both "is it on" and "for how long"
+        ttl_ms = await r.pttl(_redis_key(user_id))
+    except Exception as e:
+        log.warning(f"ai mode redis lookup failed: {e}")
+        return False
+    if ttl_ms is None or ttl_ms <= 0:
+        return False
+    _active.set(int(user_id), True, ttl_ms / 1000)
+    return True
+
+
+async def _in_ai_mode_db(user_id: int) -> bool:
+    if user_id in _inactive:
+        return False
+    try:
+        until = await get_ai_mode_until(user_id)
+    except Exception as e:
+        log.warning(f"ai mode lookup failed: {e}")
+        return False
+    left = (until - datetime.utcnow()).total_seconds() if until else 0
+    if left <= 0:
+        _inactive.set(user_id, True)
+        return False
+    _active.set(user_id, True, left)
+    return True
+
+
+async def warm_ai_mode_cache():
+    """Reload windows that were open when the process (re)started."""
+    now = datetime.utcnow()
+    try:
+        docs = await active_ai_modes(now)
+    except Exception as e:
+        log.warning(f"ai mode warm-up failed: {e}")
+        return
+    for d in docs:
+        _active.set(int(d["user_id"]), True, (d["until"] - now).total_seconds())
+    if docs:
+        log.info(f"ai mode cache warmed: {len(docs)} active users")
@@ -1,9 +1,14 @@
 import os
 import logging
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from aiogram.types import Update
 from config import settings
 from bot import build_bot_and_dp, start_background_workers
+from leases import release_all_leases
+from ai import start_ai_client, close_ai_client
+from writebehind import flush_all, writebehind_metrics
+from ingest import UpdateQueue, loads
+from dedup import first_delivery, forget_update, dedup_metrics
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("earnova")
@@ -11,6 +16,7 @@ log = logging.getLogger("earnova")
 app = FastAPI()
 bot = None
 dp = None
+updates = None
 
 WEBHOOK_PATH = "/webhook"
 
@@ -24,16 +30,33 @@ def get_webhook_base() -> str:
 
 @app.on_event("startup")
 async def on_startup():
-    global bot, dp
+    global bot, dp, updates
     bot, dp = await build_bot_and_dp()
+    await start_ai_client()
+    # The AI governor admits at most AI_MAX_CONCURRENCY + AI_QUEUE_MAX handlers (the rest
+    # are refused at once), so AI traffic alone can never occupy the whole pool
+    workers = max(
+        settings.INGEST_WORKERS,
+        settings.AI_MAX_CONCURRENCY + settings.AI_QUEUE_MAX + settings.INGEST_MIN_FREE_WORKERS,
+    )
+    updates = UpdateQueue(
+        process_update, workers, settings.INGEST_MAX_PENDING,
+        kinds=dp.resolve_used_update_types(),
+    )
+    updates.start()
     webhook_url = f"{get_webhook_base()}{WEBHOOK_PATH}"
-    await bot.set_webhook(webhook_url, drop_pending_updates=True)
+    await bot.set_webhook(webhook_url, drop_pending_updates=True, allowed_updates=dp.resolve_used_update_types())
     await start_background_workers(bot)
     log.info(f"✅ Webhook set: {webhook_url}")
 
 @app.on_event("shutdown")
 async def on_shutdown():
     global bot
+    if updates:
+        await updates.drain(settings.INGEST_DRAIN_SEC)
+    await flush_all()
+    await release_all_leases()
+    await close_ai_client()
     if bot:
         await bot.session.close()
 
@@ -45,19 +68,48 @@ async def root():
 async def health():
     return {"ok": True}
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "ingest": updates.metrics() if updates else None,
+        "writebehind": writebehind_metrics(),
+        "dedup": dedup_metrics(),
+    }
+
 @app.get("/set-webhook")
 async def set_webhook():
-    global bot
+    global bot, dp
     webhook_url = f"{get_webhook_base()}{WEBHOOK_PATH}"
-    await bot.set_webhook(webhook_url, drop_pending_updates=True)
+    await bot.set_webhook(webhook_url, drop_pending_updates=True, allowed_updates=dp.resolve_used_update_types())
     return {"webhook": webhook_url}
 
+async def process_update(raw: dict):
+    # Validating with the bot in context mounts it on every nested object; without it
+    # feed_update re-mounts through a model_dump() + model_validate() round-trip
+    update = Update.model_validate(raw, context={"bot": bot})
+    await dp.feed_update(bot, update)
+
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(req: Request):
-    global dp, bot
+    # Ack at once; handlers run on the ingest worker pool, not on Telegram's connection
     try:
-        update = Update.model_validate(await req.json())
-        await dp.feed_update(bot, update)
+        raw = loads(await req.body())
     except Exception as e:
-        log.exception(f"Error processing update: {e}")
+        log.warning(f"Bad webhook payload: {e}")
+        return {"ok": True}
+    if not isinstance(raw, dict):
+        return {"ok": True}
+    if not updates or not updates.accepting:
+        return Response(status_code=503)
+    # Update types no router handles are acked without validation or dispatch
+    if not updates.wants(raw):
+        return {"ok": True}
+    update_id = raw.get("update_id")
+    if update_id is not None and not await first_delivery(update_id):
+        return {"ok": True}
+    if not updates.submit(raw):
+        # Full: Telegram redelivers non-2xx responses later, and that retry must not look like a duplicate
+        if update_id is not None:
+            await forget_update(update_id)
+        return Response(status_code=503)
     return {"ok": True}
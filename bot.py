@@ -4,10 +4,19 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 from config import settings
-from db import ensure_indexes
+from db import db, ensure_indexes
 from user import router as user_router
 from admin import router as admin_router
-from scheduler import proof_timeout_worker, referral_leave_worker, broadcast_worker
+from membership import router as membership_router
+from scheduler import (
+    proof_timeout_worker, referral_leave_worker, broadcast_worker, scheduled_action_worker,
+    counters_reconcile_worker,
+)
+from join_gate import refresh_required_cache, required_cache_worker
+from ai_mode import warm_ai_mode_cache
+from writebehind import writebehind_worker
+from leases import run_singleton, interrupt_legacy_jobs
+from stats import stats_refresh_worker
 
 log = logging.getLogger("earnova")
 
@@ -15,13 +24,25 @@ async def build_bot_and_dp():
     bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher()
     dp.include_router(admin_router)
+    dp.include_router(membership_router)
     dp.include_router(user_router)
     await ensure_indexes()
+    await interrupt_legacy_jobs(db.broadcast_jobs)
+    await refresh_required_cache(force=True)
+    await warm_ai_mode_cache()
     return bot, dp
 
 async def start_background_workers(bot: Bot):
     import asyncio
-    asyncio.create_task(proof_timeout_worker(bot))
-    asyncio.create_task(referral_leave_worker(bot))
-    asyncio.create_task(broadcast_worker(bot))
+    # Singletons: exactly one process runs these, elected through db.leases
+    asyncio.create_task(run_singleton("proof_timeout", lambda: proof_timeout_worker(bot)))
+    asyncio.create_task(run_singleton("referral_reconcile", lambda: referral_leave_worker(bot)))
+    asyncio.create_task(run_singleton("scheduled_actions", lambda: scheduled_action_worker(bot)))
+    asyncio.create_task(run_singleton("counters_reconcile", counters_reconcile_worker))
+    asyncio.create_task(run_singleton("stats_refresh", stats_refresh_worker))
+    # One sender at a time: the broadcast rate bucket is per process
+    asyncio.create_task(run_singleton("broadcast", lambda: broadcast_worker(bot)))
+    # Every process: caches and buffers are per process
+    asyncio.create_task(required_cache_worker())
+    asyncio.create_task(writebehind_worker())
     log.info("✅ Background workers started")
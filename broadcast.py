@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from pymongo import UpdateOne
+
+from config import settings
+from db import db
+from leases import HOLDER_ID
+from rate_limit import AsyncTokenBucket
+
+log = logging.getLogger("earnova")
+
+BROADCAST_PAGE = 100  # users per checkpoint; at most one page is re-sent after a crash
+MAX_RETRY_AFTER = 3
+
+# One bucket for the whole process: every broadcast shares Telegram's global send budget
+_bucket: AsyncTokenBucket | None = None
+
+
+def _send_bucket() -> AsyncTokenBucket:
+    global _bucket
+    if _bucket is None:
+        _bucket = AsyncTokenBucket(settings.BROADCAST_RPS)
+    return _bucket
+
+
+# Segment filters accepted by /broadcast, e.g. "lang=en active=7 min_points=10 banned=no referrers"
+SEGMENT_KEYS = ("lang", "active", "min_points", "banned", "referrers")
+
+
+def parse_segment(tokens: List[str]) -> dict:
+    """Turn /broadcast filter tokens into a segment dict. Raises ValueError on bad input."""
+    seg: dict = {}
+    for tok in tokens:
+        key, _, val = tok.partition("=")
+        key = key.strip().lower()
+        val = val.strip().lower()
+        if key == "referrers" and not val:
+            seg["referrers"] = True
+        elif key == "lang" and val in ("bn", "en"):
+            seg["lang"] = val
+        elif key == "active" and val.rstrip("d").isdigit():
+            seg["active_days"] = int(val.rstrip("d"))
+        elif key == "min_points" and val.lstrip("-").isdigit():
+            seg["min_points"] = int(val)
+        elif key == "banned" and val in ("yes", "no"):
+            seg["banned"] = val == "yes"
+        else:
+            raise ValueError(f"Unknown filter: {tok}")
+    return seg
+
+
+def segment_query(seg: dict, now: datetime) -> dict:
+    """
+    Compile a segment into a users query. Every clause hits an index from
+    ensure_indexes; equality/$in forms are used instead of $ne so they stay indexable.
+    """
+    # Only delivery failures set reachable=False; users created by other upserts
+    # (or before the flag existed) have no field and are reachable
+    q: dict = {"reachable": {"$in": [True, None]}}
+    if "lang" in seg:
+        # Users who never toggled language are on the default (bn)
+        q["language"] = {"$in": ["bn", None]} if seg["lang"] == "bn" else seg["lang"]
+    if "active_days" in seg:
+        q["last_active"] = {"$gte": now - timedelta(days=int(seg["active_days"]))}
+    if "min_points" in seg:
+        q["points"] = {"$gte": int(seg["min_points"])}
+    if "banned" in seg:
+        q["banned"] = True if seg["banned"] else {"$in": [False, None]}
+    if seg.get("referrers"):
+        q["referral_count"] = {"$gte": 1}
+    return q
+
+
+def describe_segment(seg: dict) -> str:
+    if not seg:
+        return "all users"
+    parts = []
+    if "lang" in seg:
+        parts.append(f"lang={seg['lang']}")
+    if "active_days" in seg:
+        parts.append(f"active in {seg['active_days']}d")
+    if "min_points" in seg:
+        parts.append(f"points>={seg['min_points']}")
+    if "banned" in seg:
+        parts.append("banned" if seg["banned"] else "not banned")
+    if seg.get("referrers"):
+        parts.append("referrers")
+    return ", ".join(parts)
+
+
+SENT = "sent"
+FAILED = "failed"
+
+
+def _unreachable_reason(e: Exception) -> str | None:
+    """Map a delivery error to a permanent 'cannot reach this user' reason, if it is one."""
+    msg = str(e).lower()
+    if isinstance(e, TelegramForbiddenError):
+        return "deactivated" if "deactivated" in msg else "blocked"
+    if isinstance(e, TelegramBadRequest) and "chat not found" in msg:
+        return "chat_not_found"
+    return None
+
+
+async def _deliver(bot: Bot, uid: int, job: dict) -> str:
+    """Returns SENT, FAILED, or the unreachable reason."""
+    bucket = _send_bucket()
+    src = job.get("copy_from")
+    for _ in range(MAX_RETRY_AFTER):
+        await bucket.acquire()
+        try:
+            if src:
+                # Any message type (photo, video, formatted text...) the admin replied to
+                await bot.copy_message(uid, src["chat_id"], src["message_id"])
+            else:
+                await bot.send_message(uid, job["text"])
+            return SENT
+        except TelegramRetryAfter as e:
+            log.warning(f"broadcast: flood control, pausing {e.retry_after}s")
+            bucket.pause(e.retry_after)
+        except Exception as e:
+            return _unreachable_reason(e) or FAILED
+    return FAILED
+
+
+async def _mark_unreachable(outcomes: dict):
+    """Write permanent delivery failures back in one unordered bulk_write."""
+    now = datetime.utcnow()
+    ops = [
+        UpdateOne(
+            {"user_id": uid},
+            {"$set": {"reachable": False, "unreachable_reason": reason, "unreachable_at": now}},
+        )
+        for uid, reason in outcomes.items()
+    ]
+    if ops:
+        await db.users.bulk_write(ops, ordered=False)
+
+
+async def run_broadcast(bot: Bot, job: dict):
+    """
+    Send one job to every user in its segment, in user_id order, with a pool of concurrent senders.
+    After each page the last user_id and the counters are checkpointed on the job,
+    so a restarted process picks the job up where it stopped.
+    """
+    job_id = job["_id"]
+    last_uid = int(job.get("last_user_id", 0))
+    sent = int(job.get("sent", 0))
+    failed = int(job.get("failed", 0))
+    unreachable = int(job.get("unreachable", 0))
+    sem = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+    if last_uid:
+        log.info(f"Broadcast {job_id}: resuming after user_id={last_uid} (sent={sent}, failed={failed})")
+
+    async def send(uid: int) -> str:
+        async with sem:
+            return await _deliver(bot, uid, job)
+
+    # Users who blocked the bot / were deleted are skipped via the reachable flag
+    query = segment_query(job.get("segment") or {}, job.get("created_at") or datetime.utcnow())
+    while True:
+        page = await db.users.find(
+            {**query, "user_id": {"$gt": last_uid}}, {"_id": 0, "user_id": 1}
+        ).sort("user_id", 1).limit(BROADCAST_PAGE).to_list(BROADCAST_PAGE)
+        if not page:
+            break
+        uids = [int(u["user_id"]) for u in page]
+        results = await asyncio.gather(*(send(uid) for uid in uids))
+        dead = {uid: res for uid, res in zip(uids, results) if res not in (SENT, FAILED)}
+        await _mark_unreachable(dead)
+        sent += results.count(SENT)
+        failed += len(results) - results.count(SENT)
+        unreachable += len(dead)
+        last_uid = uids[-1]
+        await db.broadcast_jobs.update_one(
+            {"_id": job_id, "owner": HOLDER_ID},
+            {"$set": {
+                "last_user_id": last_uid, "sent": sent, "failed": failed,
+                "unreachable": unreachable, "progress_at": datetime.utcnow(),
+            }},
+        )
+
+    await db.broadcast_jobs.update_one(
+        {"_id": job_id, "owner": HOLDER_ID},
+        {"$set": {"status": "done", "sent": sent, "failed": failed, "unreachable": unreachable, "finished_at": datetime.utcnow()}},
+    )
+    log.info(f"Broadcast done: sent={sent}, failed={failed} (unreachable={unreachable})")
@@ -22,6 +22,86 @@ class Settings(BaseSettings):
 
     REPLIT_DEV_DOMAIN: Optional[str] = None
 
+    # OpenRouter client and per-model circuit breakers
+    AI_TIMEOUT_SEC: float = 30
+    AI_BREAKER_THRESHOLD: int = 2
+    AI_BREAKER_COOLDOWN_SEC: float = 60
+    AI_NOT_FOUND_COOLDOWN_SEC: float = 3600
+    # Hedged requests: race the next-best model once the current one is slower than
+    # AI_HEDGE_DELAY_SEC (default: that model's recent p90 latency)
+    AI_HEDGE_ENABLED: bool = False
+    AI_HEDGE_DELAY_SEC: Optional[float] = None
+    AI_HEDGE_MAX_PARALLEL: int = 2
+    # Hard cap on total time spent answering one question
+    AI_DEADLINE_SEC: float = 45
+    # Answer cache keyed by normalized question + language (Redis tier when REDIS_URL is set)
+    AI_CACHE_SIZE: int = 5000
+    AI_CACHE_TTL_SEC: int = 86400
+    # Upstream AI admission control: concurrent calls, waiting room, max wait for a slot
+    AI_MAX_CONCURRENCY: int = 8
+    AI_QUEUE_MAX: int = 32
+    AI_QUEUE_WAIT_SEC: float = 15
+    # Stream AI answers into one message, editing it at most once per interval
+    AI_STREAMING: bool = True
+    AI_STREAM_EDIT_INTERVAL_SEC: float = 1.5
+    # How long "Ask AI" stays on, and how many active users each process remembers
+    AI_MODE_SEC: int = 60
+    AI_MODE_CACHE_SIZE: int = 50000
+    # Without Redis, "not in AI mode" answers from Mongo are remembered this long
+    AI_MODE_NEGATIVE_TTL_SEC: float = 2
+
+    # Write-behind buffers for append-only logs: flush on size or time, drop oldest past max
+    WRITE_BEHIND_BATCH: int = 500
+    WRITE_BEHIND_FLUSH_SEC: float = 2
+    WRITE_BEHIND_MAX_PENDING: int = 20000
+    # users.last_active is written at most once per user per interval
+    LAST_ACTIVE_INTERVAL_SEC: int = 300
+
+    # Webhook ingestion: updates are acked at once and processed by a per-chat ordered
+    # worker pool; past INGEST_MAX_PENDING the webhook sheds load with 503
+    INGEST_WORKERS: int = 64
+    # AI answers hold a worker for as long as their governor slot (queue wait + deadline);
+    # the pool is sized so this many workers stay free with AI admission at its limit
+    INGEST_MIN_FREE_WORKERS: int = 16
+    INGEST_MAX_PENDING: int = 2000
+    INGEST_DRAIN_SEC: float = 20
+    # Drop webhook redeliveries by update_id: per-process LRU, shared through Redis
+    # when REDIS_URL is set, else through a Mongo TTL collection if UPDATE_DEDUP_MONGO
+    UPDATE_DEDUP_SIZE: int = 100000
+    UPDATE_DEDUP_TTL_SEC: int = 3600
+    UPDATE_DEDUP_MONGO: bool = False
+
+    # How often each process re-checks db.config required_version for channel changes
+    REQUIRED_CACHE_REFRESH_SEC: int = 15
+
+    # Max users tracked by the in-process rate limiter (used when Redis is absent)
+    RATE_LIMIT_LOCAL_SIZE: int = 100000
+
+    # Join-gate membership cache (shared through Redis when REDIS_URL is set)
+    MEMBERSHIP_CACHE_SIZE: int = 50000
+    MEMBERSHIP_TTL_OK: int = 300
+    MEMBERSHIP_TTL_MISSING: int = 15
+    # Membership index rows (from chat_member updates) are trusted for this long
+    MEMBERSHIP_INDEX_MAX_AGE: int = 86400
+    # Polling is only a safety net once chat_member updates keep the index current
+    REFERRAL_RECONCILE_INTERVAL: int = 21600
+    REFERRAL_RECONCILE_RPS: float = 10
+    REFERRAL_RECONCILE_CONCURRENCY: int = 8
+
+    # Leader-election leases and queue-job claims: heartbeat every TTL/3
+    LEASE_TTL_SEC: int = 30
+
+    # Drift repair interval for the materialized counters doc
+    COUNTERS_RECONCILE_SEC: int = 3600
+    # /stats snapshot refresh interval
+    STATS_REFRESH_SEC: int = 60
+    # How stale the public "Total Users" number may be
+    USER_COUNT_REFRESH_SEC: int = 60
+
+    # Broadcast sending: global messages/second and concurrent senders
+    BROADCAST_RPS: float = 25
+    BROADCAST_CONCURRENCY: int = 20
+
     @field_validator("WEBHOOK_BASE")
     @classmethod
     def _strip_slash(cls, v: str):
@@ -3,19 +3,34 @@ from __future__ import annotations
 
 import logging
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
 from cryptography.fernet import Fernet
 from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from config import settings
+from deadlines import proof_deadlines
+from writebehind import BufferedInserter, TouchCoalescer
 
 log = logging.getLogger("earnova")
 
 client = AsyncIOMotorClient(settings.MONGO_URI)
 db = client.get_default_database()
 
+# Write-behind: append-only logs and last_active stamps are batched off the request path
+ai_log_buffer = BufferedInserter(
+    db.ai_logs, settings.WRITE_BEHIND_BATCH, settings.WRITE_BEHIND_FLUSH_SEC, settings.WRITE_BEHIND_MAX_PENDING,
+)
+admin_action_buffer = BufferedInserter(
+    db.admin_actions, settings.WRITE_BEHIND_BATCH, settings.WRITE_BEHIND_FLUSH_SEC, settings.WRITE_BEHIND_MAX_PENDING,
+)
+last_active_buffer = TouchCoalescer(
+    db.users, "user_id", "last_active", settings.LAST_ACTIVE_INTERVAL_SEC,
+    settings.WRITE_BEHIND_BATCH, settings.WRITE_BEHIND_FLUSH_SEC, settings.WRITE_BEHIND_MAX_PENDING,
+)
+
 _fernet = Fernet(settings.ENCRYPTION_KEY.encode() if isinstance(settings.ENCRYPTION_KEY, str) else settings.ENCRYPTION_KEY)
 
 
@@ -24,10 +39,30 @@ async def ensure_indexes():
         await db.users.create_index("user_id", unique=True)
         await db.users.create_index("referrer_id")
         await db.users.create_index("last_active")
+        await db.users.create_index("created_at")
+        await db.users.create_index([("reachable", 1), ("user_id", 1)])
+        await db.users.create_index([("language", 1), ("user_id", 1)])
+        await db.users.create_index([("banned", 1), ("user_id", 1)])
+        await db.users.create_index("points")
+        await db.users.create_index("referral_count")
         await db.resources.create_index("status")
         await db.proofs.create_index([("user_id", 1), ("status", 1)])
         await db.proofs.create_index("deadline")
+        await db.proofs.create_index([("status", 1), ("deadline", 1)])
+        await db.proofs.create_index("expire_batch", sparse=True)
         await db.channels.create_index("channel_id", unique=True)
+        await db.memberships.create_index([("user_id", 1), ("channel_id", 1)], unique=True)
+        await db.memberships.create_index([("channel_id", 1), ("user_id", 1)])
+        await db.referrals.create_index("referred_id")
+        await db.referrals.create_index([("left_at", 1), ("last_checked_at", 1)])
+        await db.broadcast_jobs.create_index([("status", 1), ("created_at", 1)])
+        await db.leases.create_index("expires_at", expireAfterSeconds=0)
+        await db.scheduled_actions.create_index("run_at")
+        # ai_state.until used to be a float timestamp; TTL indexes only expire dates
+        await db.ai_state.delete_many({"until": {"$not": {"$type": "date"}}})
+        await db.ai_state.create_index("user_id", unique=True)
+        await db.ai_state.create_index("until", expireAfterSeconds=0)
+        await db.seen_updates.create_index("seen_at", expireAfterSeconds=settings.UPDATE_DEDUP_TTL_SEC)
     except Exception:
         pass
 
@@ -43,33 +78,120 @@ def decrypt_secret(token: str) -> str:
         return "(decryption error)"
 
 
+COUNTERS_ID = "stats"
+
+
+async def _inc_counters(**deltas: int):
+    """Keep the materialized counters doc in step with a write. Best effort: reconcile_counters fixes drift."""
+    deltas = {k: int(v) for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    try:
+        await db.counters.update_one({"_id": COUNTERS_ID}, {"$inc": deltas}, upsert=True)
+    except Exception as e:
+        log.warning(f"counters: $inc {deltas} failed: {e}")
+
+
+async def _inc_daily(**deltas: int):
+    """Bump today's row in the stats_daily rollup (new_users, claims, proofs, expiries, bans)."""
+    deltas = {k: int(v) for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    try:
+        await db.stats_daily.update_one(
+            {"_id": datetime.utcnow().strftime("%Y-%m-%d")}, {"$inc": deltas}, upsert=True
+        )
+    except Exception as e:
+        log.warning(f"stats_daily: $inc {deltas} failed: {e}")
+
+
+async def _count_user_insert(result):
+    if result.upserted_id is not None:
+        await _inc_counters(users_total=1)
+        await _inc_daily(new_users=1)
+
+
+async def get_counters() -> dict:
+    """O(1) inventory/stats counters; built on first use."""
+    doc = await db.counters.find_one({"_id": COUNTERS_ID})
+    # $inc upserts can create a partial doc before any full count; only
+    # reconcile_counters stamps reconciled_at, so its absence means "never built"
+    if doc is None or "reconciled_at" not in doc:
+        doc = await reconcile_counters()
+    return doc
+
+
+async def reconcile_counters() -> dict:
+    """Recount from the collections and overwrite the counters doc (drift repair)."""
+    counts = {
+        # Collection metadata, not a scan: users is the one collection that grows without bound
+        "users_total": await db.users.estimated_document_count(),
+        "resources_total": await db.resources.count_documents({}),
+        "resources_available": await db.resources.count_documents({"status": "available"}),
+        "resources_assigned": await db.resources.count_documents({"status": "assigned"}),
+        "proofs_pending": await db.proofs.count_documents({"status": "pending"}),
+        "proofs_submitted": await db.proofs.count_documents({"status": "submitted"}),
+        "proofs_expired": await db.proofs.count_documents({"status": "expired"}),
+    }
+    before = await db.counters.find_one_and_update(
+        {"_id": COUNTERS_ID},
+        {"$set": {**counts, "reconciled_at": datetime.utcnow()}},
+        upsert=True,
+    )
+    if before:
+        drift = {k: v - int(before.get(k, 0)) for k, v in counts.items() if v != before.get(k, 0)}
+        if drift:
+            log.info(f"counters: reconciled, drift={drift}")
+    return {"_id": COUNTERS_ID, **counts}
+
+
+def touch_user(user_id: int):
+    """Mark a user active; written at most once per LAST_ACTIVE_INTERVAL_SEC."""
+    last_active_buffer.touch(int(user_id))
+
+
+def log_admin_action(admin_id: int, action: str, payload: dict):
+    admin_action_buffer.add({"admin_id": int(admin_id), "action": action, "payload": payload, "ts": datetime.utcnow()})
+
+
+def log_ai_answer(user_id: int, lang: str, question: str, answer: str):
+    ai_log_buffer.add({"user_id": int(user_id), "lang": lang, "q": question, "a": answer, "ts": datetime.utcnow()})
+
+
 async def upsert_user(user_id: int, username: str | None, referrer_id: int | None = None):
     now = datetime.utcnow()
     update_doc = {
         "$set": {
             "username": username,
-            "last_active": now,
+            # Talking to the bot again means it can reach them again
+            "reachable": True,
         },
         "$setOnInsert": {
             "user_id": user_id,
             "created_at": now,
+            "last_active": now,
         },
     }
     if referrer_id:
         update_doc["$setOnInsert"]["referrer_id"] = referrer_id
-    await db.users.update_one({"user_id": user_id}, update_doc, upsert=True)
+    res = await db.users.update_one({"user_id": user_id}, update_doc, upsert=True)
+    await _count_user_insert(res)
+    if not res.upserted_id:
+        touch_user(user_id)
 
 
-async def get_user(user_id: int):
-    return await db.users.find_one({"user_id": user_id})
+async def get_user(user_id: int, projection: Optional[dict] = None):
+    return await db.users.find_one({"user_id": user_id}, projection)
 
 
 async def set_language(user_id: int, lang: str):
-    await db.users.update_one(
+    res = await db.users.update_one(
         {"user_id": user_id},
-        {"$set": {"language": lang, "last_active": datetime.utcnow()}},
+        {"$set": {"language": lang}, "$setOnInsert": {"last_active": datetime.utcnow()}},
         upsert=True,
     )
+    await _count_user_insert(res)
+    touch_user(user_id)
 
 
 async def set_user_lang(user_id: int, lang: str):
@@ -77,27 +199,29 @@ async def set_user_lang(user_id: int, lang: str):
 
 
 async def add_balance(user_id: int, amount: int):
-    await db.users.update_one(
+    res = await db.users.update_one(
         {"user_id": user_id},
         {
             "$inc": {"balance": int(amount)},
-            "$set": {"last_active": datetime.utcnow()},
-            "$setOnInsert": {"created_at": datetime.utcnow(), "user_id": user_id},
+            "$setOnInsert": {"created_at": datetime.utcnow(), "last_active": datetime.utcnow(), "user_id": user_id},
         },
         upsert=True,
     )
+    await _count_user_insert(res)
+    touch_user(user_id)
 
 
 async def inc_referral(referrer_id: int):
-    await db.users.update_one(
+    res = await db.users.update_one(
         {"user_id": referrer_id},
         {
             "$inc": {"referral_count": 1},
-            "$set": {"last_active": datetime.utcnow()},
-            "$setOnInsert": {"created_at": datetime.utcnow(), "user_id": referrer_id},
+            "$setOnInsert": {"created_at": datetime.utcnow(), "last_active": datetime.utcnow(), "user_id": referrer_id},
         },
         upsert=True,
     )
+    await _count_user_insert(res)
+    touch_user(referrer_id)
 
 
 async def referral_counts(user_id: int) -> int:
@@ -106,30 +230,36 @@ async def referral_counts(user_id: int) -> int:
 
 
 async def inc_points(user_id: int, delta: int):
-    await db.users.update_one(
+    res = await db.users.update_one(
         {"user_id": user_id},
         {
             "$inc": {"points": delta},
-            "$set": {"last_active": datetime.utcnow()},
-            "$setOnInsert": {"created_at": datetime.utcnow(), "user_id": user_id},
+            "$setOnInsert": {"created_at": datetime.utcnow(), "last_active": datetime.utcnow(), "user_id": user_id},
         },
         upsert=True,
     )
+    await _count_user_insert(res)
+    touch_user(user_id)
 
 
 async def set_banned(user_id: int, banned: bool):
-    await db.users.update_one(
+    res = await db.users.update_one(
         {"user_id": user_id},
-        {"$set": {"banned": banned, "last_active": datetime.utcnow()}},
+        {"$set": {"banned": banned}, "$setOnInsert": {"last_active": datetime.utcnow()}},
         upsert=True,
     )
+    await _count_user_insert(res)
+    touch_user(user_id)
+    if banned:
+        await _inc_daily(bans=1)
 
 
 async def inc_accounts_taken(user_id: int, delta: int = 1):
     await db.users.update_one(
         {"user_id": user_id},
-        {"$inc": {"accounts_taken": delta}, "$set": {"last_active": datetime.utcnow()}},
+        {"$inc": {"accounts_taken": delta}},
     )
+    touch_user(user_id)
 
 
 async def add_channel(channel_id: int, ch_type: str):
@@ -153,11 +283,73 @@ async def list_channels() -> List[dict]:
     return await cursor.to_list(length=None)
 
 
+async def record_membership(channel_id: int, user_id: int, joined: bool, status: str, source: str):
+    """Upsert one row of the membership index (fed by chat_member updates and API checks)."""
+    await db.memberships.update_one(
+        {"user_id": int(user_id), "channel_id": int(channel_id)},
+        {"$set": {"joined": bool(joined), "status": status, "source": source, "updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+async def get_memberships(user_id: int, channel_ids: List[int], since: datetime,
+                          source: Optional[str] = None) -> Dict[int, bool]:
+    """Known membership verdicts for one user, ignoring rows older than `since` (and from other sources)."""
+    q = {"user_id": int(user_id), "channel_id": {"$in": [int(c) for c in channel_ids]}, "updated_at": {"$gte": since}}
+    if source:
+        q["source"] = source
+    cursor = db.memberships.find(q, {"_id": 0, "channel_id": 1, "joined": 1})
+    return {int(d["channel_id"]): bool(d["joined"]) async for d in cursor}
+
+
+async def get_channel_memberships(channel_id: int, user_ids: List[int], since: datetime) -> Dict[int, bool]:
+    """Known verdicts for many users in one channel, ignoring rows older than `since`."""
+    cursor = db.memberships.find(
+        {"channel_id": int(channel_id), "user_id": {"$in": [int(u) for u in user_ids]}, "updated_at": {"$gte": since}},
+        {"_id": 0, "user_id": 1, "joined": 1},
+    )
+    return {int(d["user_id"]): bool(d["joined"]) async for d in cursor}
+
+
+async def set_ai_mode_until(user_id: int, until: datetime):
+    """Durable copy of a user's AI-mode window; the TTL index on `until` removes it afterwards."""
+    await db.ai_state.update_one(
+        {"user_id": int(user_id)},
+        {"$set": {"until": until}},
+        upsert=True,
+    )
+
+
+async def get_ai_mode_until(user_id: int) -> Optional[datetime]:
+    doc = await db.ai_state.find_one({"user_id": int(user_id)}, {"_id": 0, "until": 1})
+    return doc.get("until") if doc else None
+
+
+async def active_ai_modes(now: datetime) -> List[dict]:
+    cursor = db.ai_state.find({"until": {"$gt": now}}, {"_id": 0, "user_id": 1, "until": 1})
+    return await cursor.to_list(length=None)
+
+
+async def claim_update_id(update_id: int) -> bool:
+    """First delivery of this update_id wins; redeliveries collide on _id."""
+    try:
+        await db.seen_updates.insert_one({"_id": int(update_id), "seen_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def release_update_id(update_id: int):
+    await db.seen_updates.delete_one({"_id": int(update_id)})
+
+
 async def _bump_required_version():
+    # Always strictly increasing, even for two bumps within the same second,
+    # so version-polling caches never miss a change.
     now = int(datetime.utcnow().timestamp())
     await db.config.update_one(
         {"key": "required_version"},
-        {"$set": {"value": now}},
+        [{"$set": {"value": {"$max": [now, {"$add": [{"$ifNull": ["$value", 0]}, 1]}]}}}],
         upsert=True,
     )
 
@@ -180,6 +372,7 @@ async def add_resource(name: str, secret_plain: str, cost: int = 0, default_flag
         "created_at": datetime.utcnow(),
     }
     result = await db.resources.insert_one(doc)
+    await _inc_counters(resources_total=1, resources_available=1)
     return result.inserted_id
 
 
@@ -188,8 +381,16 @@ async def remove_resource(resource_id: str) -> bool:
         oid = ObjectId(resource_id)
     except Exception:
         return False
-    result = await db.resources.delete_one({"_id": oid})
-    return result.deleted_count > 0
+    removed = await db.resources.find_one_and_delete({"_id": oid}, projection={"status": 1})
+    if not removed:
+        return False
+    status = removed.get("status")
+    await _inc_counters(
+        resources_total=-1,
+        resources_available=-1 if status == "available" else 0,
+        resources_assigned=-1 if status == "assigned" else 0,
+    )
+    return True
 
 
 async def list_resources(limit: int = 30) -> List[dict]:
@@ -198,7 +399,7 @@ async def list_resources(limit: int = 30) -> List[dict]:
 
 
 async def count_available_resources() -> int:
-    return await db.resources.count_documents({"status": "available"})
+    return int((await get_counters()).get("resources_available", 0))
 
 
 async def claim_resource_for_user(user_id: int) -> Optional[dict]:
@@ -214,16 +415,19 @@ async def claim_resource_for_user(user_id: int) -> Optional[dict]:
         return_document=ReturnDocument.AFTER,
     )
     if resource:
+        await _inc_counters(resources_available=-1, resources_assigned=1)
+        await _inc_daily(claims=1)
         log.info(f"claim_resource_for_user: SUCCESS user={user_id} id={resource['_id']} name={resource.get('name')}")
     else:
-        total = await db.resources.count_documents({})
-        avail = await db.resources.count_documents({"status": "available"})
+        counters = await get_counters()
+        total = counters.get("resources_total", 0)
+        avail = counters.get("resources_available", 0)
         log.warning(f"claim_resource_for_user: NONE user={user_id} total_resources={total} available={avail}")
     return resource
 
 
 async def create_pending_proof(user_id: int, resource_id: str, status: str, deadline: datetime):
-    await db.proofs.insert_one({
+    result = await db.proofs.insert_one({
         "user_id": user_id,
         "resource_id": resource_id,
         "status": status,
@@ -233,6 +437,8 @@ async def create_pending_proof(user_id: int, resource_id: str, status: str, dead
         "created_at": datetime.utcnow(),
         "posted": [],
     })
+    proof_deadlines.push(deadline, result.inserted_id)
+    await _inc_counters(proofs_pending=1)
 
 
 async def attach_proof_file(user_id: int, file_id: str) -> Optional[dict]:
@@ -242,34 +448,54 @@ async def attach_proof_file(user_id: int, file_id: str) -> Optional[dict]:
         sort=[("created_at", -1)],
         return_document=True,
     )
+    if proof:
+        await _inc_counters(proofs_pending=-1, proofs_submitted=1)
+        await _inc_daily(proofs=1)
     return proof
 
 
-async def pending_proofs_due(now: datetime, limit: int = 200) -> List[dict]:
-    cursor = db.proofs.find({"status": "pending", "deadline": {"$lte": now}}).limit(limit)
-    return await cursor.to_list(length=limit)
+async def pending_proof_deadlines(until: datetime) -> List[dict]:
+    """Pending proofs due by `until` (includes anything already overdue)."""
+    cursor = db.proofs.find({"status": "pending", "deadline": {"$lte": until}}, {"deadline": 1})
+    return await cursor.to_list(length=None)
 
 
-async def expire_proof(proof_id: ObjectId):
-    await db.proofs.update_one(
-        {"_id": proof_id},
-        {"$set": {"status": "expired", "expired_at": datetime.utcnow()}},
+async def expire_proofs(proof_ids: List[ObjectId], now: datetime) -> List[dict]:
+    """
+    Expire a batch of overdue proofs, free their resources and ban their users:
+    four round-trips for the whole batch instead of four per proof.
+    Only proofs still pending are touched, so a screenshot that lands first wins.
+    Returns the proofs that were actually expired.
+    """
+    batch = ObjectId()
+    flipped = await db.proofs.update_many(
+        {"_id": {"$in": proof_ids}, "status": "pending", "deadline": {"$lte": now}},
+        {"$set": {"status": "expired", "expired_at": now, "expire_batch": batch}},
     )
-
-
-async def free_resource_by_proof(proof: dict):
-    """Release an assigned resource back to available when proof expires."""
-    rid_str = proof.get("resource_id")
-    if not rid_str:
-        return
-    try:
-        oid = ObjectId(rid_str)
-    except Exception:
-        return
-    await db.resources.update_one(
-        {"_id": oid, "status": "assigned"},
-        {"$set": {"status": "available", "assigned_to": None, "assigned_at": None}},
+    expired = await db.proofs.find({"expire_batch": batch}, {"user_id": 1, "resource_id": 1}).to_list(length=None)
+    await _inc_counters(proofs_pending=-flipped.modified_count, proofs_expired=flipped.modified_count)
+    await _inc_daily(expiries=flipped.modified_count)
+    if not expired:
+        return []
+
+    oids = []
+    for p in expired:
+        try:
+            oids.append(ObjectId(p.get("resource_id")))
+        except Exception:
+            continue
+    if oids:
+        freed = await db.resources.update_many(
+            {"_id": {"$in": oids}, "status": "assigned"},
+            {"$set": {"status": "available", "assigned_to": None, "assigned_at": None}},
+        )
+        await _inc_counters(resources_available=freed.modified_count, resources_assigned=-freed.modified_count)
+    banned = await db.users.update_many(
+        {"user_id": {"$in": list({int(p["user_id"]) for p in expired})}, "banned": {"$ne": True}},
+        {"$set": {"banned": True}},
     )
+    await _inc_daily(bans=banned.modified_count)
+    return expired
 
 
 async def reset_all_stuck_resources() -> int:
@@ -278,18 +504,45 @@ async def reset_all_stuck_resources() -> int:
         {"status": "assigned"},
         {"$set": {"status": "available", "assigned_to": None, "assigned_at": None}},
     )
+    await _inc_counters(resources_available=result.modified_count, resources_assigned=-result.modified_count)
     return result.modified_count
 
 
+async def schedule_message_delete(chat_id: int, message_id: int, run_at: datetime):
+    """Queue a message for deletion; survives restarts, unlike a sleeping task."""
+    await db.scheduled_actions.insert_one({
+        "kind": "delete_message",
+        "chat_id": int(chat_id),
+        "message_id": int(message_id),
+        "run_at": run_at,
+        "created_at": datetime.utcnow(),
+    })
+
+
+async def due_scheduled_actions(now: datetime, limit: int = 500) -> List[dict]:
+    cursor = db.scheduled_actions.find({"run_at": {"$lte": now}}).sort("run_at", 1).limit(limit)
+    return await cursor.to_list(length=limit)
+
+
+async def next_scheduled_action_at() -> Optional[datetime]:
+    doc = await db.scheduled_actions.find_one({}, {"run_at": 1}, sort=[("run_at", 1)])
+    return doc["run_at"] if doc else None
+
+
+async def delete_scheduled_actions(ids: List[ObjectId]):
+    await db.scheduled_actions.delete_many({"_id": {"$in": ids}})
+
+
 async def mark_referred_left(referred_id: int):
     now = datetime.utcnow()
-    referral = await db.referrals.find_one({"referred_id": referred_id, "left_at": None})
-    if not referral:
-        return
-    await db.referrals.update_one(
-        {"_id": referral["_id"]},
+    # Claim the leave atomically: the chat_member handler and the reconciler can both
+    # see it, and only the caller that flips left_at may take the points back
+    referral = await db.referrals.find_one_and_update(
+        {"referred_id": referred_id, "left_at": None},
         {"$set": {"left_at": now}},
     )
+    if not referral:
+        return
     referrer_id = referral.get("referrer_id")
     if referrer_id:
         pts = int(referral.get("points_awarded", 10))
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+from datetime import datetime
+from typing import Any, Hashable, List, Optional, Set, Tuple
+
+
+class DeadlineHeap:
+    """
+    Min-heap of (deadline, key) with a wake-up event, so one timer loop can sleep
+    exactly until the next deadline. Pushes are ignored unless a consumer has
+    activated the heap, so processes that don't run the timer never accumulate entries.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int, Hashable]] = []
+        self._keys: Set[Hashable] = set()
+        self._seq = 0  # tie-breaker so keys never get compared
+        self._wake = asyncio.Event()
+        self.active = False
+
+    def activate(self):
+        self.clear()
+        self.active = True
+
+    def deactivate(self):
+        self.active = False
+        self.clear()
+
+    def clear(self):
+        self._heap.clear()
+        self._keys.clear()
+
+    def push(self, when: datetime, key: Hashable):
+        if not self.active or key in self._keys:
+            return
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, key))
+        self._keys.add(key)
+        if self._heap[0][2] == key:
+            self._wake.set()
+
+    def next_due(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, until: datetime, limit: int) -> List[Any]:
+        out = []
+        while self._heap and self._heap[0][0] <= until and len(out) < limit:
+            _, _, key = heapq.heappop(self._heap)
+            self._keys.discard(key)
+            out.append(key)
+        return out
+
+    async def wait(self, timeout: float):
+        """Sleep up to `timeout` seconds, or until an earlier deadline is pushed."""
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+# Fed by db.create_pending_proof, consumed by scheduler.proof_timeout_worker
+proof_deadlines = DeadlineHeap()
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import logging
+
+from cache import TTLCache
+from config import settings
+from db import claim_update_id, release_update_id
+from rate_limit import async_redis_client
+
+log = logging.getLogger("earnova")
+
+# update_ids this process has already accepted. Telegram redelivers an update when
+# our answer was slow or failed; the retry normally lands on the same process, and
+# the shared tier (Redis, or Mongo) covers the rest.
+_seen = TTLCache(settings.UPDATE_DEDUP_SIZE, settings.UPDATE_DEDUP_TTL_SEC)
+
+duplicates = 0
+
+
+def _redis_key(update_id: int) -> str:
+    return f"upd:{int(update_id)}"
+
+
+async def first_delivery(update_id: int) -> bool:
+    """True the first time an update_id is seen; False for redeliveries."""
+    global duplicates
+    if update_id in _seen:
+        duplicates += 1
+        return False
+    _seen.set(update_id, True)
+
+    fresh = True
+    r = async_redis_client()
+    try:
+        if r:
+            fresh = bool(await r.set(_redis_key(update_id), "1", nx=True, ex=settings.UPDATE_DEDUP_TTL_SEC))
+        elif settings.UPDATE_DEDUP_MONGO:
+            fresh = await claim_update_id(update_id)
+    except Exception as e:
+        # Shared store down: the local LRU still catches same-process retries
+        log.warning(f"update dedup store failed for {update_id}: {e}")
+    if not fresh:
+        duplicates += 1
+    return fresh
+
+
+async def forget_update(update_id: int):
+    """Undo first_delivery for an update we could not accept, so its redelivery runs."""
+    _seen.pop(update_id)
+    r = async_redis_client()
+    try:
+        if r:
+            await r.delete(_redis_key(update_id))
+        elif settings.UPDATE_DEDUP_MONGO:
+            await release_update_id(update_id)
+    except Exception as e:
+        log.warning(f"update dedup release failed for {update_id}: {e}")
+
+
+def dedup_metrics() -> dict:
+    return {"tracked": len(_seen), "duplicates": duplicates}
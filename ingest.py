@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json otherwise
+    orjson = None
+
+log = logging.getLogger("earnova")
+
+
+def loads(body: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def update_kind(raw: dict) -> Optional[str]:
+    """The update type ("message", "callback_query", ...): its only key besides update_id."""
+    for kind in raw:
+        if kind != "update_id":
+            return kind
+    return None
+
+
+def chat_key(raw: dict) -> int:
+    """
+    Ordering key for a raw update: the chat it belongs to, else the sender,
+    else the update itself (no ordering needed). Membership changes are keyed by
+    the member, not the channel: that keeps them in order with the user's own
+    messages (private chat id == user id) and lets different users run in parallel.
+    """
+    for kind, payload in raw.items():
+        if kind == "update_id" or not isinstance(payload, dict):
+            continue
+        if kind in ("chat_member", "my_chat_member"):
+            member = (payload.get("new_chat_member") or {}).get("user") or payload.get("from") or {}
+            if "id" in member:
+                return int(member["id"])
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+        sender = payload.get("from") or payload.get("user")
+        if sender and "id" in sender:
+            return int(sender["id"])
+    return -int(raw.get("update_id", 0))
+
+
+class UpdateQueue:
+    """
+    Bounded ingestion queue between the webhook and the dispatcher.
+
+    Updates are grouped per chat: a chat's updates run strictly one after another,
+    different chats run in parallel on `workers` tasks. A chat with a backlog gets
+    one update per turn, so a single busy chat cannot starve the rest. Once
+    `max_pending` updates are waiting, submit() refuses new ones (load shedding)
+    and the webhook answers 503 so Telegram redelivers them later.
+    """
+
+    def __init__(self, handler: Callable[[dict], Awaitable[Any]], workers: int, max_pending: int,
+                 kinds: Optional[Iterable[str]] = None):
+        self.handler = handler
+        self.workers = int(workers)
+        self.max_pending = int(max_pending)
+        # Update types some handler is registered for; None = accept everything
+        self.kinds: Optional[Set[str]] = set(kinds) if kinds is not None else None
+        self._chats: Dict[int, Deque[Tuple[float, dict]]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.accepting = False
+        self.pending = 0
+        self.running = 0
+        self.accepted = 0
+        self.shed = 0
+        self.ignored = 0
+        self.processed = 0
+        self.errors = 0
+        self._waits: deque = deque(maxlen=500)
+
+    def start(self):
+        self.accepting = True
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def wants(self, raw: dict) -> bool:
+        """Cheap pre-check on the raw dict: is there a handler for this update type at all?"""
+        if self.kinds is None or update_kind(raw) in self.kinds:
+            return True
+        self.ignored += 1
+        return False
+
+    def submit(self, raw: dict) -> bool:
+        if not self.accepting or self.pending >= self.max_pending:
+            self.shed += 1
+            return False
+        key = chat_key(raw)
+        q = self._chats.get(key)
+        if q is None:
+            # New or idle chat: schedule it. A chat already in _chats is either
+            # queued in _ready or being worked on and will be rescheduled.
+            q = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        q.append((time.monotonic(), raw))
+        self.pending += 1
+        self.accepted += 1
+        self._idle.clear()
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            q = self._chats[key]
+            enqueued_at, raw = q.popleft()
+            self._waits.append(time.monotonic() - enqueued_at)
+            self.running += 1
+            try:
+                await self.handler(raw)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                log.exception(f"Error processing update {raw.get('update_id')}: {e}")
+            finally:
+                self.running -= 1
+                self.pending -= 1
+            if q:
+                self._ready.put_nowait(key)
+            else:
+                del self._chats[key]
+            if self.pending == 0:
+                self._idle.set()
+
+    async def drain(self, timeout: Optional[float] = None):
+        """Stop accepting, finish what is queued (up to `timeout`), then stop the workers."""
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"ingest drain timed out with {self.pending} updates pending")
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def metrics(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "accepting": self.accepting,
+            "workers": self.workers,
+            "running": self.running,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "chats": len(self._chats),
+            "accepted": self.accepted,
+            "shed": self.shed,
+            "ignored": self.ignored,
+            "processed": self.processed,
+            "errors": self.errors,
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p90": waits[max(int(len(waits) * 0.9) - 1, 0)] if waits else 0.0,
+        }
@@ -1,21 +1,33 @@
 from __future__ import annotations
 
-import time
+import asyncio
 import logging
-from typing import Tuple, List, Dict
+from datetime import datetime, timedelta
+from typing import Tuple, List, Dict, Optional
 from aiogram import Bot
 
+from cache import TTLCache
 from config import settings
-from db import list_channels, get_required_version
+from db import list_channels, get_required_version, get_memberships, record_membership
+from rate_limit import async_redis_client
 
 log = logging.getLogger("earnova")
 
-# In-memory cache: {user_id: (is_ok, missing_cid, expires_at)}
-_membership_cache: Dict[int, Tuple[bool, int, float]] = {}
-_CACHE_TTL = 60  # seconds — re-check channel membership every 60s
+# Bounded LRU: {(required_version, user_id): (is_ok, missing_cid)}.
+# Joined and missing verdicts get separate TTLs; Redis (if configured) shares them across workers.
+_membership_cache = TTLCache(settings.MEMBERSHIP_CACHE_SIZE, settings.MEMBERSHIP_TTL_OK)
 
+# Process-local copy of the required channel list, keyed by db.config required_version.
+# Every worker polls the version doc (one tiny read) and reloads channels only when it moved.
+_required_cache: Dict[str, object] = {"version": None, "channels": None}
 
-async def required_channels() -> List[int]:
+
+async def refresh_required_cache(force: bool = False):
+    # Read the version first: a bump racing with the channel read leaves us one version
+    # behind, which the next poll corrects, never ahead with a stale channel list.
+    v = await get_required_version()
+    if not force and v == _required_cache["version"] and _required_cache["channels"] is not None:
+        return
     chs = await list_channels()
     req = [settings.REQUIRED_CHANNEL_ID]
     for c in chs:
@@ -23,39 +35,144 @@ async def required_channels() -> List[int]:
             cid = int(c["channel_id"])
             if cid not in req:
                 req.append(cid)
-    return req
+    if v != _required_cache["version"]:
+        log.info(f"required channels reloaded: version={v} channels={req}")
+    _required_cache["version"] = v
+    _required_cache["channels"] = req
 
 
-async def check_user_joined(bot: Bot, user_id: int) -> Tuple[bool, int, List[int]]:
-    now = time.monotonic()
-    cached = _membership_cache.get(user_id)
-    req = await required_channels()
+async def required_cache_worker():
+    while True:
+        await asyncio.sleep(settings.REQUIRED_CACHE_REFRESH_SEC)
+        try:
+            await refresh_required_cache()
+        except Exception as e:
+            log.warning(f"required_cache_worker refresh failed: {e}")
 
-    if cached and now < cached[2]:
-        ok, missing = cached[0], cached[1]
-        log.debug(f"check_user_joined: CACHE HIT user={user_id} ok={ok}")
-        return ok, missing, req
 
-    for cid in req:
+async def required_channels() -> List[int]:
+    if _required_cache["channels"] is None:
+        await refresh_required_cache(force=True)
+    return list(_required_cache["channels"])
+
+
+def _member_key(user_id: int) -> Tuple[int, int]:
+    # Keyed by required_version so a channel change never serves a stale verdict
+    return int(_required_cache["version"] or 0), int(user_id)
+
+
+async def _cache_get(user_id: int) -> Optional[Tuple[bool, int]]:
+    key = _member_key(user_id)
+    hit = _membership_cache.get(key)
+    if hit is not None:
+        return hit
+    r = async_redis_client()
+    if not r:
+        return None
+    try:
+        raw = await r.get(f"mg:{key[0]}:{key[1]}")
+    except Exception as e:
+        log.warning(f"membership cache redis get failed: {e}")
+        return None
+    if raw is None:
+        return None
+    # "1" = joined everything, "0:<cid>" = missing <cid>
+    hit = (True, 0) if raw == "1" else (False, int(raw.split(":", 1)[1]))
+    _membership_cache.set(key, hit, _ttl_for(hit[0]))
+    return hit
+
+
+async def _cache_set(user_id: int, ok: bool, missing: int):
+    key = _member_key(user_id)
+    ttl = _ttl_for(ok)
+    _membership_cache.set(key, (ok, missing), ttl)
+    r = async_redis_client()
+    if not r:
+        return
+    try:
+        await r.set(f"mg:{key[0]}:{key[1]}", "1" if ok else f"0:{missing}", ex=ttl)
+    except Exception as e:
+        log.warning(f"membership cache redis set failed: {e}")
+
+
+def _ttl_for(ok: bool) -> int:
+    return settings.MEMBERSHIP_TTL_OK if ok else settings.MEMBERSHIP_TTL_MISSING
+
+
+def member_status(member) -> str:
+    return str(getattr(member.status, "value", member.status))
+
+
+async def _is_member(bot: Bot, cid: int, user_id: int) -> bool:
+    try:
+        m = await bot.get_chat_member(cid, user_id)
+    except Exception as e:
+        log.warning(f"check_user_joined: get_chat_member failed cid={cid} user={user_id}: {e} — treating as OK")
+        # If the bot cannot check (e.g. not admin in channel), do NOT lock the user out
+        return True
+    status = member_status(m)
+    joined = status not in ("left", "kicked")
+    try:
+        await record_membership(cid, user_id, joined, status, "api")
+    except Exception as e:
+        log.warning(f"check_user_joined: record_membership failed cid={cid} user={user_id}: {e}")
+    return joined
+
+
+async def check_user_joined(bot: Bot, user_id: int, req: Optional[List[int]] = None,
+                            live: bool = False) -> Tuple[bool, int, List[int]]:
+    """
+    live=True (used by /start) skips the caches and the membership index and asks
+    the Bot API, so a user who just joined is never held back by an old verdict.
+    """
+    if req is None:
+        req = await required_channels()
+
+    if not live:
+        cached = await _cache_get(user_id)
+        if cached is not None:
+            ok, missing = cached
+            log.debug(f"check_user_joined: CACHE HIT user={user_id} ok={ok}")
+            return ok, missing, req
+
+    # Channels with a fresh membership-index row written by a chat_member update need
+    # no Bot API call. Rows from our own API checks are not trusted here: a "not joined"
+    # answer goes stale the moment the user joins.
+    known: Dict[int, bool] = {}
+    if not live:
+        since = datetime.utcnow() - timedelta(seconds=settings.MEMBERSHIP_INDEX_MAX_AGE)
         try:
-            m = await bot.get_chat_member(cid, user_id)
-            if m.status in ("left", "kicked"):
-                _membership_cache[user_id] = (False, cid, now + _CACHE_TTL)
-                log.info(f"check_user_joined: user={user_id} NOT in channel={cid}")
-                return False, cid, req
+            known = await get_memberships(user_id, req, since, source="event")
         except Exception as e:
-            log.warning(f"check_user_joined: get_chat_member failed cid={cid} user={user_id}: {e} — treating as OK")
-            # If the bot cannot check (e.g. not admin in channel), do NOT lock the user out
-            continue
+            log.warning(f"check_user_joined: membership index lookup failed user={user_id}: {e}")
+    unknown = [cid for cid in req if cid not in known]
+    results = await asyncio.gather(*(_is_member(bot, cid, user_id) for cid in unknown))
+    known.update(zip(unknown, results))
+
+    for cid in req:
+        if not known[cid]:
+            await _cache_set(user_id, False, cid)
+            log.info(f"check_user_joined: user={user_id} NOT in channel={cid}")
+            return False, cid, req
 
-    _membership_cache[user_id] = (True, 0, now + _CACHE_TTL)
+    await _cache_set(user_id, True, 0)
     return True, 0, req
 
 
-def invalidate_membership_cache(user_id: int):
+async def invalidate_membership_cache(user_id: int):
     """Call this after /start to force a fresh membership check."""
-    _membership_cache.pop(user_id, None)
+    key = _member_key(user_id)
+    _membership_cache.pop(key)
+    r = async_redis_client()
+    if not r:
+        return
+    try:
+        await r.delete(f"mg:{key[0]}:{key[1]}")
+    except Exception as e:
+        log.warning(f"membership cache redis delete failed: {e}")
 
 
 async def current_required_version() -> int:
-    return await get_required_version()
+    if _required_cache["channels"] is None:
+        await refresh_required_cache(force=True)
+    return int(_required_cache["version"])
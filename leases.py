@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Set
+from pymongo.errors import DuplicateKeyError
+
+from config import settings
+from db import db
+
+log = logging.getLogger("earnova")
+
+# Identifies this process in db.leases and in claimed queue jobs
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+_held: Set[str] = set()
+
+
+async def acquire_lease(name: str, ttl: int) -> bool:
+    """
+    Take or renew the named lease. Succeeds if nobody holds it, we already
+    hold it, or the holder stopped heartbeating. Otherwise the upsert
+    collides on _id and we lose.
+    """
+    now = datetime.utcnow()
+    try:
+        await db.leases.update_one(
+            {"_id": name, "$or": [{"holder": HOLDER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": HOLDER_ID, "expires_at": now + timedelta(seconds=ttl), "renewed_at": now}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        _held.discard(name)
+        return False
+    _held.add(name)
+    return True
+
+
+async def release_all_leases():
+    """Hand leases back on shutdown so another process takes over without waiting out the TTL."""
+    for name in list(_held):
+        try:
+            await db.leases.delete_one({"_id": name, "holder": HOLDER_ID})
+        except Exception as e:
+            log.warning(f"lease {name}: release failed: {e}")
+        _held.discard(name)
+
+
+async def run_singleton(name: str, worker: Callable[[], Awaitable[Any]], ttl: int | None = None):
+    """
+    Run `worker()` on exactly one process: only while this process holds the
+    `name` lease. The lease is renewed every ttl/3; if a renewal fails the
+    worker is cancelled and we go back to competing for the lease.
+    """
+    ttl = ttl or settings.LEASE_TTL_SEC
+    while True:
+        try:
+            got = await acquire_lease(name, ttl)
+        except Exception as e:
+            log.warning(f"lease {name}: acquire failed: {e}")
+            got = False
+        if not got:
+            await asyncio.sleep(ttl / 3)
+            continue
+
+        log.info(f"lease {name}: acquired by {HOLDER_ID}")
+        task = asyncio.create_task(worker())
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=ttl / 3)
+                if done:
+                    if not task.cancelled() and task.exception():
+                        log.error(f"lease {name}: worker crashed: {task.exception()!r}")
+                    break
+                try:
+                    still_ours = await acquire_lease(name, ttl)
+                except Exception as e:
+                    log.warning(f"lease {name}: renew failed: {e}")
+                    still_ours = False
+                if not still_ours:
+                    log.warning(f"lease {name}: lost, stopping worker on {HOLDER_ID}")
+                    break
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(ttl / 3)
+
+
+async def claim_job(collection, query: dict, ttl: int | None = None) -> dict | None:
+    """
+    Atomically claim the oldest job matching `query`, or one whose owner's claim
+    has lapsed, and mark it running under this process.
+    """
+    ttl = ttl or settings.LEASE_TTL_SEC
+    now = datetime.utcnow()
+    return await collection.find_one_and_update(
+        # Only jobs claimed through here carry lease_until; a running job without one
+        # predates checkpoints and would restart from scratch (see interrupt_legacy_jobs)
+        {"$or": [query, {"status": "running", "lease_until": {"$exists": True, "$lt": now}}]},
+        {
+            "$set": {"status": "running", "owner": HOLDER_ID, "lease_until": now + timedelta(seconds=ttl)},
+            "$min": {"started_at": now},
+        },
+        sort=[("created_at", 1)],
+        return_document=True,
+    )
+
+
+async def interrupt_legacy_jobs(collection) -> int:
+    """
+    Park jobs left "running" by code that never leased them (no lease_until, no
+    checkpoint) as "interrupted", instead of re-sending them from the start.
+    """
+    try:
+        res = await collection.update_many(
+            {"status": "running", "lease_until": {"$exists": False}},
+            {"$set": {"status": "interrupted", "interrupted_at": datetime.utcnow()}},
+        )
+    except Exception as e:
+        log.warning(f"interrupt_legacy_jobs on {collection.name} failed: {e}")
+        return 0
+    if res.modified_count:
+        log.info(f"{collection.name}: {res.modified_count} legacy running jobs marked interrupted")
+    return res.modified_count
+
+
+async def keep_claim(collection, job_id: Any, ttl: int | None = None):
+    """Heartbeat a claimed job; returns as soon as the claim is no longer ours."""
+    ttl = ttl or settings.LEASE_TTL_SEC
+    while True:
+        await asyncio.sleep(ttl / 3)
+        try:
+            res = await collection.update_one(
+                {"_id": job_id, "owner": HOLDER_ID},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=ttl)}},
+            )
+        except Exception as e:
+            log.warning(f"job {job_id}: heartbeat failed: {e}")
+            continue
+        if res.matched_count == 0:
+            return
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import logging
+from aiogram import Router
+from aiogram.types import ChatMemberUpdated
+
+from config import settings
+from db import record_membership, mark_referred_left
+from join_gate import required_channels, invalidate_membership_cache, member_status
+
+log = logging.getLogger("earnova")
+
+router = Router()
+
+
+@router.chat_member()
+async def on_chat_member(ev: ChatMemberUpdated):
+    """
+    Keep the membership index current from Telegram's push updates.
+    Requires the bot to be an admin of each required channel and
+    "chat_member" in the webhook's allowed_updates.
+    """
+    cid = int(ev.chat.id)
+    if cid not in await required_channels():
+        return
+    uid = int(ev.new_chat_member.user.id)
+    status = member_status(ev.new_chat_member)
+    joined = status not in ("left", "kicked")
+
+    await record_membership(cid, uid, joined, status, "event")
+    await invalidate_membership_cache(uid)
+    log.info(f"chat_member: user={uid} channel={cid} status={status}")
+
+    if not joined and cid == settings.REQUIRED_CHANNEL_ID:
+        await mark_referred_left(uid)
@@ -1,26 +1,138 @@
 from __future__ import annotations
+import asyncio
+import logging
 import time
-from typing import Optional
-import redis
+import uuid
+from typing import Dict, NamedTuple, Optional
+import redis.asyncio as aioredis
+from cache import TTLCache
 from config import settings
 
-_r: Optional[redis.Redis] = None
+log = logging.getLogger("earnova")
 
-def redis_client() -> Optional[redis.Redis]:
-    global _r
+_ar: Optional[aioredis.Redis] = None
+_sliding_window = None
+
+
+def async_redis_client() -> Optional[aioredis.Redis]:
+    global _ar
     if not settings.REDIS_URL:
         return None
-    if _r is None:
-        _r = redis.from_url(settings.REDIS_URL, decode_responses=True)
-    return _r
-
-def allow(user_id: int, key: str, window_sec: int = 2, limit: int = 3) -> bool:
-    r = redis_client()
-    if not r:
-        return True
-    now = int(time.time())
-    bucket = f"rl:{key}:{user_id}:{now//window_sec}"
-    n = r.incr(bucket)
-    if n == 1:
-        r.expire(bucket, window_sec + 1)
-    return n <= limit
+    if _ar is None:
+        _ar = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _ar
+
+
+class Policy(NamedTuple):
+    limit: int
+    window_sec: float
+
+
+# Named per-action limits: at most `limit` hits in any rolling `window_sec`
+POLICIES: Dict[str, Policy] = {
+    "start": Policy(limit=3, window_sec=2),
+    "get_account": Policy(limit=1, window_sec=30),
+}
+
+# Sliding-window log in a sorted set; trim + count + add + expire in one atomic round-trip.
+# Returns 0 when allowed, otherwise milliseconds until the oldest hit leaves the window.
+_SLIDING_WINDOW_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+if redis.call('ZCARD', KEYS[1]) < limit then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return math.max(tonumber(oldest[2]) + window - now, 1)
+"""
+
+# Fallback when Redis is absent or failing: {(policy, user_id): (tokens, updated_at)}.
+# A token bucket with capacity=limit refilling limit/window per second. Per process, bounded.
+_local_buckets = TTLCache(settings.RATE_LIMIT_LOCAL_SIZE, ttl=3600)
+
+
+def _local_hit(name: str, user_id: int, p: Policy) -> float:
+    now = time.monotonic()
+    rate = p.limit / p.window_sec
+    tokens, updated = _local_buckets.get((name, user_id), (float(p.limit), now))
+    tokens = min(float(p.limit), tokens + (now - updated) * rate)
+    if tokens >= 1:
+        _local_buckets.set((name, user_id), (tokens - 1, now), ttl=p.window_sec)
+        return 0.0
+    _local_buckets.set((name, user_id), (tokens, now), ttl=p.window_sec)
+    return (1 - tokens) / rate
+
+
+async def hit(name: str, user_id: int) -> float:
+    """Record one hit against policy `name`. Returns 0 if allowed, else seconds to wait."""
+    p = POLICIES[name]
+    r = async_redis_client()
+    if r:
+        global _sliding_window
+        if _sliding_window is None:
+            _sliding_window = r.register_script(_SLIDING_WINDOW_LUA)
+        now_ms = int(time.time() * 1000)
+        try:
+            wait_ms = await _sliding_window(
+                keys=[f"rl:{name}:{user_id}"],
+                args=[now_ms, int(p.window_sec * 1000), p.limit, f"{now_ms}:{uuid.uuid4().hex[:8]}"],
+            )
+            return int(wait_ms) / 1000
+        except Exception as e:
+            log.warning(f"rate_limit: redis failed ({e}), using in-process limiter")
+    return _local_hit(name, user_id, p)
+
+
+async def allow(user_id: int, key: str) -> bool:
+    return await hit(key, user_id) == 0
+
+
+async def reset(name: str, user_id: int):
+    """Forget a user's hits for `name` (e.g. the action failed through no fault of theirs)."""
+    _local_buckets.pop((name, user_id))
+    r = async_redis_client()
+    if r:
+        try:
+            await r.delete(f"rl:{name}:{user_id}")
+        except Exception as e:
+            log.warning(f"rate_limit: redis reset failed: {e}")
+
+
+class AsyncTokenBucket:
+    """Paces outbound calls: `await acquire()` waits until a token is available."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. Telegram's retry_after)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self, n: float = 1):
+        async with self._lock:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    self._updated = time.monotonic()
+                    continue
+                self._refill()
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                await asyncio.sleep((n - self._tokens) / self.rate)
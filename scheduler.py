@@ -2,82 +2,270 @@ from __future__ import annotations
 
 import asyncio
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Optional
 from aiogram import Bot
 
 from config import settings
-from db import db, pending_proofs_due, expire_proof, free_resource_by_proof, set_banned, mark_referred_left
+from db import (
+    db, pending_proof_deadlines, expire_proofs, mark_referred_left,
+    get_channel_memberships, record_membership,
+    due_scheduled_actions, next_scheduled_action_at, delete_scheduled_actions, reconcile_counters,
+)
+from deadlines import proof_deadlines
+from broadcast import run_broadcast
+from join_gate import member_status
+from leases import claim_job, keep_claim
+from rate_limit import AsyncTokenBucket
 
 log = logging.getLogger("earnova")
 
+PROOF_SYNC_SEC = 30         # pick up proofs created by other processes
+PROOF_LOOKAHEAD_SEC = 900   # > proof lifetime (10 min), so each proof is queued well before it is due
+PROOF_COALESCE_SEC = 1      # expire everything due within this window in one batch
+PROOF_BATCH = 500
+NOTICE_LIMIT = 3500         # stay under Telegram's 4096-char message limit
+
+
 async def proof_timeout_worker(bot: Bot):
+    """
+    Expires each pending proof at its exact deadline. Deadlines come from an
+    in-memory heap: pushed locally by create_pending_proof, and synced from
+    Mongo at startup and every PROOF_SYNC_SEC for proofs created elsewhere.
+    """
+    proof_deadlines.activate()
+    try:
+        next_sync = 0.0
+        while True:
+            try:
+                loop_now = asyncio.get_running_loop().time()
+                if loop_now >= next_sync:
+                    until = datetime.utcnow() + timedelta(seconds=PROOF_LOOKAHEAD_SEC)
+                    for p in await pending_proof_deadlines(until):
+                        proof_deadlines.push(p["deadline"], p["_id"])
+                    next_sync = loop_now + PROOF_SYNC_SEC
+
+                now = datetime.utcnow()
+                due = proof_deadlines.pop_due(now + timedelta(seconds=PROOF_COALESCE_SEC), PROOF_BATCH)
+                if due:
+                    await _expire_batch(bot, due)
+                    continue
+
+                nxt = proof_deadlines.next_due()
+                timeout = next_sync - loop_now
+                if nxt is not None:
+                    timeout = min(timeout, (nxt - now).total_seconds())
+                await proof_deadlines.wait(timeout)
+            except Exception as e:
+                log.exception(f"proof_timeout_worker error: {e}")
+                await asyncio.sleep(5)
+    finally:
+        proof_deadlines.deactivate()
+
+
+async def _expire_batch(bot: Bot, proof_ids: list):
+    # Entries popped within the coalesce window may be up to a moment early; wait it out
+    await asyncio.sleep(PROOF_COALESCE_SEC)
+    expired = await expire_proofs(proof_ids, datetime.utcnow())
+    if not expired:
+        return
+    log.info(f"Auto-banned {len(expired)} user(s) for missing proof. Resources freed.")
+
+    # One channel notice per batch instead of one message per ban
+    lines = [f"User {int(p['user_id'])} — resource={p.get('resource_id')}" for p in expired]
+    header = f"Auto-ban: {len(expired)} user(s) did not submit screenshot in time.\n"
+    chunk = header
+    for line in lines:
+        if len(chunk) + len(line) + 1 > NOTICE_LIMIT:
+            await _notify(bot, chunk)
+            chunk = ""
+        chunk += line + "\n"
+    if chunk:
+        await _notify(bot, chunk)
+
+
+async def _notify(bot: Bot, text: str):
+    try:
+        await bot.send_message(settings.PROOF_CHANNEL_PUBLIC, text)
+    except Exception:
+        pass
+
+
+ACTION_POLL_SEC = 15  # upper bound on sleep; actions are inserted by every process
+ACTION_BATCH = 500
+DELETE_MESSAGES_MAX = 100  # Bot API deleteMessages limit
+
+
+async def scheduled_action_worker(bot: Bot):
+    """One timer loop for every queued db.scheduled_actions entry (currently message deletes)."""
     while True:
         try:
-            due = await pending_proofs_due(datetime.utcnow(), limit=200)
-            for p in due:
-                await expire_proof(p["_id"])
-                await free_resource_by_proof(p)
-                uid = int(p["user_id"])
-                await set_banned(uid, True)
-                log.info(f"Auto-banned user {uid} for missing proof. Resource freed.")
-                try:
-                    await bot.send_message(
-                        settings.PROOF_CHANNEL_PUBLIC,
-                        f"Auto-ban: User {uid} did not submit screenshot in time.\nResource={p.get('resource_id')}",
-                    )
-                except Exception:
-                    pass
+            now = datetime.utcnow()
+            due = await due_scheduled_actions(now, limit=ACTION_BATCH)
+            if due:
+                await _delete_messages(bot, [a for a in due if a.get("kind") == "delete_message"])
+                await delete_scheduled_actions([a["_id"] for a in due])
+                continue
+            nxt = await next_scheduled_action_at()
+            timeout = ACTION_POLL_SEC
+            if nxt is not None:
+                timeout = min(timeout, (nxt - now).total_seconds())
+            await asyncio.sleep(max(timeout, 0.5))
         except Exception as e:
-            log.exception(f"proof_timeout_worker error: {e}")
-        await asyncio.sleep(60)
+            log.exception(f"scheduled_action_worker error: {e}")
+            await asyncio.sleep(5)
+
+
+async def _delete_messages(bot: Bot, actions: list):
+    by_chat: dict = {}
+    for a in actions:
+        by_chat.setdefault(int(a["chat_id"]), []).append(int(a["message_id"]))
+    for chat_id, mids in by_chat.items():
+        for i in range(0, len(mids), DELETE_MESSAGES_MAX):
+            try:
+                await bot.delete_messages(chat_id, mids[i:i + DELETE_MESSAGES_MAX])
+            except Exception as e:
+                # Already deleted / too old to delete: nothing left to do
+                log.debug(f"scheduled delete failed chat={chat_id}: {e}")
+
+
+RECONCILE_STATE_ID = "referral_reconcile"
+RECONCILE_PAGE = 500
 
 
 async def referral_leave_worker(bot: Bot):
+    """
+    Slow reconciliation pass. Leaves are normally handled the moment they happen by
+    membership.on_chat_member; this only catches updates missed while the bot was
+    down or not an admin. Progress lives in db.worker_state, so a restart resumes
+    the pass in flight instead of starting over.
+    """
     while True:
         try:
-            main = settings.REQUIRED_CHANNEL_ID
-            cursor = db.referrals.find({"left_at": None})
-            async for r in cursor:
-                referred = int(r["referred_id"])
-                try:
-                    m = await bot.get_chat_member(main, referred)
-                    if m.status in ("left", "kicked"):
-                        await mark_referred_left(referred)
-                except Exception:
+            state = await db.worker_state.find_one({"_id": RECONCILE_STATE_ID}) or {}
+            last = state.get("last_pass_finished_at")
+            if not state.get("running") and last:
+                wait = settings.REFERRAL_RECONCILE_INTERVAL - (datetime.utcnow() - last).total_seconds()
+                if wait > 0:
+                    await asyncio.sleep(wait)
                     continue
+            await _reconcile_referrals(bot, state)
         except Exception as e:
             log.exception(f"referral_leave_worker error: {e}")
-        await asyncio.sleep(600)
+            await asyncio.sleep(60)
+
+
+async def _reconcile_referrals(bot: Bot, state: dict):
+    main = settings.REQUIRED_CHANNEL_ID
+    if state.get("running"):
+        started = state["pass_started_at"]
+        checked = int(state.get("checked", 0))
+        log.info(f"referral reconcile: resuming pass from {started.isoformat()} (checked={checked})")
+    else:
+        started = datetime.utcnow()
+        checked = 0
+        await db.worker_state.update_one(
+            {"_id": RECONCILE_STATE_ID},
+            {"$set": {"running": True, "pass_started_at": started, "checked": 0}},
+            upsert=True,
+        )
+
+    # Everything still open that this pass has not looked at, stalest (or never checked) first
+    query = {"left_at": None, "last_checked_at": {"$not": {"$gte": started}}}
+    backlog = await db.referrals.count_documents(query)
+    bucket = AsyncTokenBucket(settings.REFERRAL_RECONCILE_RPS)
+    sem = asyncio.Semaphore(settings.REFERRAL_RECONCILE_CONCURRENCY)
+
+    while True:
+        page = await db.referrals.find(query, {"referred_id": 1}).sort("last_checked_at", 1).limit(RECONCILE_PAGE).to_list(RECONCILE_PAGE)
+        if not page:
+            break
+        referred = [int(r["referred_id"]) for r in page]
+        since = datetime.utcnow() - timedelta(seconds=settings.MEMBERSHIP_INDEX_MAX_AGE)
+        known = await get_channel_memberships(main, referred, since)
+
+        async def check(uid: int):
+            async with sem:
+                await _reconcile_one(bot, bucket, main, uid, known.get(uid))
+
+        await asyncio.gather(*(check(uid) for uid in referred))
+        await db.referrals.update_many(
+            {"_id": {"$in": [r["_id"] for r in page]}},
+            {"$set": {"last_checked_at": datetime.utcnow()}},
+        )
+        checked += len(page)
+        backlog = max(backlog - len(page), 0)
+        await db.worker_state.update_one(
+            {"_id": RECONCILE_STATE_ID},
+            {"$set": {"checked": checked, "backlog": backlog, "checkpoint_at": datetime.utcnow()}},
+        )
+
+    duration = (datetime.utcnow() - started).total_seconds()
+    await db.worker_state.update_one(
+        {"_id": RECONCILE_STATE_ID},
+        {"$set": {
+            "running": False,
+            "backlog": 0,
+            "last_pass_checked": checked,
+            "last_pass_duration": duration,
+            "last_pass_finished_at": datetime.utcnow(),
+        }},
+    )
+    log.info(f"referral reconcile: pass done checked={checked} duration={duration:.0f}s")
+
+
+async def _reconcile_one(bot: Bot, bucket: AsyncTokenBucket, main: int, referred: int, known: Optional[bool]):
+    try:
+        if known is None:
+            # No fresh chat_member-fed row: fall back to the Bot API, within the rate budget
+            await bucket.acquire()
+            m = await bot.get_chat_member(main, referred)
+            status = member_status(m)
+            known = status not in ("left", "kicked")
+            await record_membership(main, referred, known, status, "api")
+        if not known:
+            await mark_referred_left(referred)
+    except Exception as e:
+        log.debug(f"referral reconcile: check failed user={referred}: {e}")
 
 
 async def broadcast_worker(bot: Bot):
+    """
+    Runs under the "broadcast" lease, so at most one broadcast is being sent at a
+    time and BROADCAST_RPS holds across processes (each bucket is process-local).
+    Jobs are still claimed atomically with a heartbeat: after a failover, a job
+    whose owner stopped heartbeating is reclaimed and resumes from its checkpoint.
+    """
     while True:
         try:
-            job = await db.broadcast_jobs.find_one({"status": "queued"}, sort=[("created_at", 1)])
+            job = await claim_job(db.broadcast_jobs, {"status": "queued"})
             if not job:
                 await asyncio.sleep(10)
                 continue
-            await db.broadcast_jobs.update_one({"_id": job["_id"]}, {"$set": {"status": "running"}})
-
-            text = job["text"]
-            sent = 0
-            failed = 0
-            cursor = db.users.find({}, {"user_id": 1})
-            async for u in cursor:
-                uid = int(u["user_id"])
-                try:
-                    await bot.send_message(uid, text)
-                    sent += 1
-                except Exception:
-                    failed += 1
-                if (sent + failed) % 25 == 0:
-                    await asyncio.sleep(1.2)
-
-            await db.broadcast_jobs.update_one(
-                {"_id": job["_id"]},
-                {"$set": {"status": "done", "sent": sent, "failed": failed}},
-            )
-            log.info(f"Broadcast done: sent={sent}, failed={failed}")
+            work = asyncio.create_task(run_broadcast(bot, job))
+            heartbeat = asyncio.create_task(keep_claim(db.broadcast_jobs, job["_id"]))
+            try:
+                done, _ = await asyncio.wait({work, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+                if heartbeat in done:
+                    log.warning(f"Broadcast {job['_id']}: claim lost, stopping here")
+                else:
+                    work.result()
+            finally:
+                # Also reached when run_singleton cancels us after losing the lease:
+                # asyncio.wait does not cancel its tasks, and orphans would keep sending
+                for t in (work, heartbeat):
+                    t.cancel()
+                await asyncio.gather(work, heartbeat, return_exceptions=True)
         except Exception as e:
             log.exception(f"broadcast_worker error: {e}")
             await asyncio.sleep(10)
+
+
+async def counters_reconcile_worker():
+    """Repair drift in the materialized counters doc: once at startup, then periodically."""
+    while True:
+        try:
+            await reconcile_counters()
+        except Exception as e:
+            log.exception(f"counters_reconcile_worker error: {e}")
+        await asyncio.sleep(settings.COUNTERS_RECONCILE_SEC)
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from db import get_user
+from join_gate import required_channels, current_required_version
+
+# Only the fields the user-facing handlers actually read
+USER_PROJECTION = {
+    "_id": 0,
+    "user_id": 1,
+    "points": 1,
+    "referral_count": 1,
+    "accounts_taken": 1,
+    "language": 1,
+    "banned": 1,
+    "joined_required_version": 1,
+}
+
+
+class UserSnapshot:
+    """
+    Per-update view of the user document plus the join-gate config.
+    Loaded lazily on first use, then shared by locked() and the handler,
+    so one button press costs one round-trip per source instead of 3-5.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = int(user_id)
+        self.user: Optional[dict] = None
+        self.required: List[int] = []
+        self.required_version: int = 1
+        self._loaded = False
+
+    async def load(self) -> "UserSnapshot":
+        if not self._loaded:
+            self.user, self.required, self.required_version = await asyncio.gather(
+                get_user(self.user_id, projection=USER_PROJECTION),
+                required_channels(),
+                current_required_version(),
+            )
+            self._loaded = True
+        return self
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.user.get(key, default) if self.user else default
+
+
+class SnapshotMiddleware(BaseMiddleware):
+    """Injects a fresh `snap: UserSnapshot` into every handler call."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None:
+            data["snap"] = UserSnapshot(user.id)
+        return await handler(event, data)
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from config import settings
+from db import db, get_counters, COUNTERS_ID
+
+log = logging.getLogger("earnova")
+
+SNAPSHOT_ID = "stats_snapshot"
+
+
+async def _user_counts(today_start: datetime) -> dict:
+    # The $match narrows to banned/new users through their indexes before the
+    # $facet splits them, so this never scans the whole users collection.
+    pipeline = [
+        {"$match": {"$or": [{"banned": True}, {"created_at": {"$gte": today_start}}]}},
+        {"$facet": {
+            "banned": [{"$match": {"banned": True}}, {"$count": "n"}],
+            "new_today": [{"$match": {"created_at": {"$gte": today_start}}}, {"$count": "n"}],
+        }},
+    ]
+    rows = await db.users.aggregate(pipeline).to_list(length=1)
+    facet = rows[0] if rows else {}
+    return {k: (facet.get(k) or [{"n": 0}])[0]["n"] for k in ("banned", "new_today")}
+
+
+async def compute_stats() -> dict:
+    today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    # Resource and proof figures come from the write-maintained counters doc:
+    # proofs grows without bound and must not be grouped every refresh.
+    users, channels, ai_chats, counters = await asyncio.gather(
+        _user_counts(today_start),
+        db.channels.count_documents({}),
+        db.ai_logs.estimated_document_count(),
+        get_counters(),
+    )
+    return {
+        "users": int(counters.get("users_total", 0)),
+        "banned": users["banned"],
+        "new_today": users["new_today"],
+        "resources_total": int(counters.get("resources_total", 0)),
+        "resources_available": int(counters.get("resources_available", 0)),
+        "resources_assigned": int(counters.get("resources_assigned", 0)),
+        "channels": channels,
+        "proofs_pending": int(counters.get("proofs_pending", 0)),
+        "ai_chats": ai_chats,
+        "computed_at": datetime.utcnow(),
+    }
+
+
+async def refresh_stats_snapshot() -> dict:
+    snap = await compute_stats()
+    await db.counters.update_one({"_id": SNAPSHOT_ID}, {"$set": snap}, upsert=True)
+    return snap
+
+
+async def get_stats_snapshot() -> dict:
+    """Cached /stats numbers; recomputed here only if the refresher has fallen behind."""
+    snap = await db.counters.find_one({"_id": SNAPSHOT_ID})
+    max_age = timedelta(seconds=settings.STATS_REFRESH_SEC * 3)
+    if not snap or datetime.utcnow() - snap.get("computed_at", datetime.min) > max_age:
+        snap = await refresh_stats_snapshot()
+    return snap
+
+
+async def stats_refresh_worker():
+    while True:
+        try:
+            await refresh_stats_snapshot()
+        except Exception as e:
+            log.exception(f"stats_refresh_worker error: {e}")
+        await asyncio.sleep(settings.STATS_REFRESH_SEC)
+
+
+# Process-local "Total users" value: the public button must never trigger a scan
+_user_count = {"value": None, "at": 0.0}
+_user_count_lock = asyncio.Lock()
+
+
+async def cached_user_count() -> int:
+    """
+    Total users, refreshed at most every USER_COUNT_REFRESH_SEC per process.
+    Reads the insert-maintained counter; falls back to collection metadata
+    (estimated_document_count), never count_documents.
+    """
+    if _user_count["value"] is not None and time.monotonic() - _user_count["at"] < settings.USER_COUNT_REFRESH_SEC:
+        return _user_count["value"]
+    async with _user_count_lock:
+        # Another caller may have refreshed while we waited
+        if _user_count["value"] is not None and time.monotonic() - _user_count["at"] < settings.USER_COUNT_REFRESH_SEC:
+            return _user_count["value"]
+        try:
+            doc = await db.counters.find_one({"_id": COUNTERS_ID}, {"users_total": 1})
+            value = int(doc["users_total"]) if doc and "users_total" in doc else await db.users.estimated_document_count()
+        except Exception as e:
+            log.warning(f"cached_user_count refresh failed: {e}")
+            if _user_count["value"] is None:
+                raise
+            value = _user_count["value"]
+        _user_count["value"] = value
+        _user_count["at"] = time.monotonic()
+        return value
+
+
+async def daily_range(start: str, end: str) -> List[dict]:
+    """Rollup rows for days start..end inclusive (YYYY-MM-DD keys)."""
+    cursor = db.stats_daily.find({"_id": {"$gte": start, "$lte": end}}).sort("_id", 1)
+    return await cursor.to_list(length=None)
@@ -3,11 +3,12 @@ from __future__ import annotations
 import asyncio
 import logging
 import time
+from contextlib import aclosing
 from datetime import datetime, timedelta
-from typing import Dict
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 from config import settings
 from keyboards import (
@@ -15,26 +16,27 @@ from keyboards import (
     BTN_BALANCE, BTN_REFERRAL, BTN_INFO, BTN_HELP, BTN_AI, BTN_LANG, BTN_TOTAL, BTN_GET
 )
 from db import (
-    upsert_user, get_user, referral_counts, claim_resource_for_user, count_available_resources,
-    decrypt_secret, inc_accounts_taken, create_pending_proof, attach_proof_file, db, set_user_lang
+    upsert_user, claim_resource_for_user, count_available_resources,
+    decrypt_secret, inc_accounts_taken, create_pending_proof, attach_proof_file, db, set_user_lang,
+    schedule_message_delete, log_ai_answer,
 )
-from join_gate import check_user_joined, current_required_version, invalidate_membership_cache
-from rate_limit import allow
-from ai import ask_ai
+from join_gate import check_user_joined, invalidate_membership_cache
+from snapshot import SnapshotMiddleware, UserSnapshot
+from stats import cached_user_count
+from rate_limit import allow, hit, reset
+from ai import ask_ai, ask_ai_stream, UNAVAILABLE
+from ai_mode import enable_ai_mode, in_ai_mode
 
 log = logging.getLogger("earnova")
 
 router = Router()
+router.message.middleware(SnapshotMiddleware())
 
-# Per-user rate limit for Get Account: stores last claim timestamp
-_get_account_last: Dict[int, float] = {}
-GET_ACCOUNT_COOLDOWN = 30  # seconds between Get Account presses per user
-
-
-async def locked(bot: Bot, m: Message) -> bool:
+async def locked(bot: Bot, m: Message, snap: UserSnapshot) -> bool:
     uid = m.from_user.id
+    await snap.load()
     try:
-        ok, missing, _ = await check_user_joined(bot, uid)
+        ok, missing, _ = await check_user_joined(bot, uid, snap.required)
     except Exception as e:
         log.warning(f"locked() check_user_joined raised: {e} — treating as OK")
         ok, missing = True, 0
@@ -48,12 +50,14 @@ async def locked(bot: Bot, m: Message) -> bool:
         )
         return True
 
-    user = await get_user(uid)
-    v = await current_required_version()
+    user = snap.user
+    v = snap.required_version
     user_ver = int(user.get("joined_required_version", 0)) if user else 0
     log.info(f"locked(): user={uid} user_ver={user_ver} required_ver={v}")
 
-    if user and user_ver != int(v):
+    # Versions only grow; another worker's cache may lag by REQUIRED_CACHE_REFRESH_SEC,
+    # so a user ahead of this process's view has already re-verified
+    if user and user_ver < int(v):
         await m.answer(
             "A new required channel was added.\n"
             "Please send /start again to continue."
@@ -64,11 +68,11 @@ async def locked(bot: Bot, m: Message) -> bool:
 
 
 @router.message(CommandStart())
-async def start(m: Message, bot: Bot):
-    if not allow(m.from_user.id, "start"):
+async def start(m: Message, bot: Bot, snap: UserSnapshot):
+    if not await allow(m.from_user.id, "start"):
         return
 
-    invalidate_membership_cache(m.from_user.id)
+    await invalidate_membership_cache(m.from_user.id)
 
     args = (m.text or "").split(maxsplit=1)
     ref = None
@@ -81,16 +85,17 @@ async def start(m: Message, bot: Bot):
         ref = None
 
     await upsert_user(m.from_user.id, m.from_user.username, referrer_id=ref)
+    await snap.load()
 
-    ok, _, _ = await check_user_joined(bot, m.from_user.id)
+    ok, _, _ = await check_user_joined(bot, m.from_user.id, snap.required, live=True)
     if not ok:
         await m.answer("Please join our required channel first, then send /start again.")
         return
 
-    v = await current_required_version()
+    v = snap.required_version
     await db.users.update_one(
         {"user_id": int(m.from_user.id)},
-        {"$set": {"joined_required_version": int(v)}}
+        {"$max": {"joined_required_version": int(v)}}
     )
 
     if ref:
@@ -103,19 +108,18 @@ async def start(m: Message, bot: Bot):
                 "left_at": None,
                 "points_awarded": 10,
             })
-            await db.users.update_one({"user_id": int(ref)}, {"$inc": {"points": 10}})
+            await db.users.update_one({"user_id": int(ref)}, {"$inc": {"points": 10, "referral_count": 1}})
 
     await m.answer("Welcome! Use the menu below.", reply_markup=main_menu_kb())
 
 
 @router.message(F.text == BTN_BALANCE)
-async def balance(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def balance(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
-    user = await get_user(m.from_user.id)
-    refs = await referral_counts(m.from_user.id)
-    pts = user.get("points", 0) if user else 0
-    taken = user.get("accounts_taken", 0) if user else 0
+    refs = int(snap.get("referral_count", 0))
+    pts = snap.get("points", 0)
+    taken = snap.get("accounts_taken", 0)
     await m.answer(
         f"Points: {pts}\n"
         f"Referrals: {refs}\n"
@@ -124,8 +128,8 @@ async def balance(m: Message, bot: Bot):
 
 
 @router.message(F.text == BTN_REFERRAL)
-async def referral(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def referral(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
     me = await bot.get_me()
     link = f"https://t.me/{me.username}?start={m.from_user.id}"
@@ -133,10 +137,10 @@ async def referral(m: Message, bot: Bot):
 
 
 @router.message(F.text == BTN_INFO)
-async def info(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def info(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
-    avail = await db.resources.count_documents({"status": "available"})
+    avail = await count_available_resources()
     await m.answer(
         f"Bot Status: Running\n"
         f"Available accounts: {avail}"
@@ -144,8 +148,8 @@ async def info(m: Message, bot: Bot):
 
 
 @router.message(F.text == BTN_HELP)
-async def help_(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def help_(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
     await m.answer(
         "How to use:\n"
@@ -158,44 +162,40 @@ async def help_(m: Message, bot: Bot):
 
 
 @router.message(F.text == BTN_LANG)
-async def language(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def language(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
-    user = await get_user(m.from_user.id)
-    cur = user.get("language", "bn") if user else "bn"
+    cur = snap.get("language", "bn")
     new = "en" if cur == "bn" else "bn"
     await set_user_lang(m.from_user.id, new)
     await m.answer(f"Language set to: {new.upper()}")
 
 
 @router.message(F.text == BTN_TOTAL)
-async def total_users(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def total_users(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
-    total = await db.users.count_documents({})
+    total = await cached_user_count()
     await m.answer(f"Total users: {total}")
 
 
 @router.message(F.text == BTN_GET)
-async def get_account(m: Message, bot: Bot):
+async def get_account(m: Message, bot: Bot, snap: UserSnapshot):
     uid = m.from_user.id
 
-    # ── Rate limit: one Get Account per 30s per user ──────────────────────────
-    now_ts = time.monotonic()
-    last = _get_account_last.get(uid, 0)
-    wait = GET_ACCOUNT_COOLDOWN - (now_ts - last)
+    # ── Rate limit: one Get Account per 30s per user (rate_limit.POLICIES) ────
+    wait = await hit("get_account", uid)
     if wait > 0:
         await m.answer(f"Please wait {int(wait)+1}s before requesting another account.")
         return
-    _get_account_last[uid] = now_ts
     # ──────────────────────────────────────────────────────────────────────────
 
-    if await locked(bot, m):
+    if await locked(bot, m, snap):
         return
 
-    user = await get_user(uid)
+    user = snap.user
     if not user:
-        await start(m, bot)
+        await start(m, bot, snap)
         return
     if user.get("banned"):
         await m.answer("You are banned from using this bot.")
@@ -216,7 +216,7 @@ async def get_account(m: Message, bot: Bot):
             "Try again later or contact admin."
         )
         # Reset rate limit so user can retry immediately
-        _get_account_last.pop(uid, None)
+        await reset("get_account", uid)
         return
 
     log.info(f"get_account: SUCCESS user={uid} resource={r.get('_id')} name={r.get('name')}")
@@ -228,20 +228,12 @@ async def get_account(m: Message, bot: Bot):
         f"Credentials: {secret}\n\n"
         "This message auto-deletes in 5 minutes."
     )
+    await schedule_message_delete(sent.chat.id, sent.message_id, datetime.utcnow() + timedelta(seconds=300))
 
     deadline = datetime.utcnow() + timedelta(minutes=10)
     await create_pending_proof(uid, str(r["_id"]), "pending", deadline)
     await m.answer("Please verify:", reply_markup=verify_kb(str(r["_id"])))
 
-    async def _del_later():
-        await asyncio.sleep(300)
-        try:
-            await sent.delete()
-        except Exception:
-            pass
-
-    asyncio.create_task(_del_later())
-
 
 @router.callback_query(F.data.startswith("verify:"))
 async def verify(cb: CallbackQuery, bot: Bot):
@@ -267,8 +259,8 @@ async def verify(cb: CallbackQuery, bot: Bot):
 
 
 @router.message(F.photo)
-async def photo(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def photo(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
     file_id = m.photo[-1].file_id
     proof = await attach_proof_file(m.from_user.id, file_id)
@@ -304,34 +296,81 @@ async def photo(m: Message, bot: Bot):
 
 
 @router.message(F.text == BTN_AI)
-async def ai_mode(m: Message, bot: Bot):
-    if await locked(bot, m):
+async def ai_mode(m: Message, bot: Bot, snap: UserSnapshot):
+    if await locked(bot, m, snap):
         return
-    await db.ai_state.update_one(
-        {"user_id": int(m.from_user.id)},
-        {"$set": {"until": datetime.utcnow().timestamp() + 60}},
-        upsert=True
-    )
-    await m.answer("AI mode on. Ask your question now. (60 seconds active)")
+    await enable_ai_mode(m.from_user.id)
+    await m.answer(f"AI mode on. Ask your question now. ({settings.AI_MODE_SEC} seconds active)")
+
+
+TG_TEXT_LIMIT = 4096
+
+
+async def _edit_reply(reply: Message, text: str) -> float:
+    """Edit the streamed reply; returns how long to hold off before the next edit."""
+    try:
+        await reply.edit_text(text[:TG_TEXT_LIMIT], parse_mode=None)
+    except TelegramRetryAfter as e:
+        return float(e.retry_after)
+    except TelegramBadRequest as e:
+        # "message is not modified" and friends: nothing to do
+        log.debug(f"ai stream edit skipped: {e}")
+    return 0.0
+
+
+async def _stream_answer(m: Message, lang: str) -> str:
+    """
+    Send the AI answer as one message that grows while tokens arrive: the first
+    chunk is sent, later ones are folded into throttled edits, and the final text
+    always lands with one last edit. Text past Telegram's limit goes out as extra messages.
+    """
+    reply = None
+    shown = ""
+    text = ""
+    next_edit = 0.0
+    # aclosing: if sending or editing fails, the governor slot is released now, not at GC
+    async with aclosing(ask_ai_stream(m.text, lang=lang, user_id=int(m.from_user.id))) as stream:
+        async for partial in stream:
+            # Telegram rejects whitespace-only text, and answers often open with "\n"
+            text = partial.strip()
+            if not text:
+                continue
+            now = time.monotonic()
+            if reply is None:
+                reply = await m.answer(text[:TG_TEXT_LIMIT], parse_mode=None)
+                shown = text
+                next_edit = now + settings.AI_STREAM_EDIT_INTERVAL_SEC
+            elif now >= next_edit and len(shown) < TG_TEXT_LIMIT:
+                hold = await _edit_reply(reply, text)
+                shown = text
+                next_edit = now + max(hold, settings.AI_STREAM_EDIT_INTERVAL_SEC)
+
+    if reply is None:
+        # Nothing but whitespace came back
+        text = UNAVAILABLE
+        await m.answer(text, parse_mode=None)
+    elif text[:TG_TEXT_LIMIT] != shown[:TG_TEXT_LIMIT]:
+        hold = await _edit_reply(reply, text)
+        if hold:
+            await asyncio.sleep(hold)
+            await _edit_reply(reply, text)
+    for i in range(TG_TEXT_LIMIT, len(text), TG_TEXT_LIMIT):
+        await m.answer(text[i:i + TG_TEXT_LIMIT], parse_mode=None)
+    return text
 
 
 @router.message(F.text)
-async def any_text(m: Message, bot: Bot):
-    st = await db.ai_state.find_one({"user_id": int(m.from_user.id)})
-    if st and float(st.get("until", 0)) >= datetime.utcnow().timestamp():
-        if await locked(bot, m):
+async def any_text(m: Message, bot: Bot, snap: UserSnapshot):
+    if await in_ai_mode(m.from_user.id):
+        if await locked(bot, m, snap):
             return
-        user = await get_user(m.from_user.id)
-        lang = user.get("language", "bn") if user else "bn"
-        ans = await ask_ai(m.text, lang=lang)
-        await db.ai_logs.insert_one({
-            "user_id": int(m.from_user.id),
-            "lang": lang,
-            "q": m.text,
-            "a": ans,
-            "ts": datetime.utcnow()
-        })
-        await m.answer(ans, parse_mode=None)
+        lang = snap.get("language", "bn")
+        if settings.AI_STREAMING:
+            ans = await _stream_answer(m, lang)
+        else:
+            ans = await ask_ai(m.text, lang=lang, user_id=int(m.from_user.id))
+            await m.answer(ans, parse_mode=None)
+        log_ai_answer(m.from_user.id, lang, m.text, ans)
         return
 
     known = {BTN_BALANCE, BTN_REFERRAL, BTN_INFO, BTN_HELP, BTN_AI, BTN_LANG, BTN_TOTAL, BTN_GET}
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from cache import TTLCache
+
+log = logging.getLogger("earnova")
+
+# Every buffer registers itself here so one worker and one shutdown hook cover them all
+_buffers: List["_Buffer"] = []
+
+
+class _Buffer(ABC):
+    name = ""
+
+    def __init__(self, max_batch: int, flush_sec: float):
+        self.max_batch = int(max_batch)
+        self.flush_sec = float(flush_sec)
+        self._full = asyncio.Event()
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+        _buffers.append(self)
+
+    @abstractmethod
+    def pending(self) -> int:
+        ...
+
+    @abstractmethod
+    async def flush(self):
+        ...
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.warning(f"write-behind {self.name} flush crashed: {e}")
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "pending": self.pending(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
+
+
+class BufferedInserter(_Buffer):
+    """
+    Write-behind buffer for one append-only collection. Documents are queued in
+    memory and written with one unordered insert_many once `max_batch` are waiting
+    or `flush_sec` has passed. Memory is bounded: past `max_pending` the oldest
+    queued documents are dropped (and counted) rather than growing without limit.
+    """
+
+    def __init__(self, collection, max_batch: int, flush_sec: float, max_pending: int):
+        super().__init__(max_batch, flush_sec)
+        self.collection = collection
+        self.name = collection.name
+        self._queue: deque = deque(maxlen=int(max_pending))
+
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def add(self, doc: dict):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(doc)
+        if len(self._queue) >= self.max_batch:
+            self._full.set()
+
+    async def flush(self):
+        while self._queue:
+            n = min(len(self._queue), self.max_batch)
+            batch = [self._queue.popleft() for _ in range(n)]
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+                self.written += n
+                continue
+            except BulkWriteError as e:
+                # Unordered: everything not listed in writeErrors went in. A duplicate key
+                # means an earlier attempt (timed out client-side) already wrote that doc.
+                failed = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                retry = [batch[err["index"]] for err in failed]
+                self.written += n - len(retry)
+                if not retry:
+                    continue
+                self.failures += 1
+                log.warning(f"write-behind flush to {self.name}: {len(retry)} of {n} docs failed: {failed[0].get('errmsg')}")
+            except Exception as e:
+                # Nothing known about what landed; docs keep their _id, so a retry that
+                # repeats an applied write comes back as duplicate keys above
+                retry = batch
+                self.failures += 1
+                log.warning(f"write-behind flush to {self.name} failed ({n} docs): {e}")
+            # Put the failed docs back for the next attempt, as far as there is room
+            room = self._queue.maxlen - len(self._queue)
+            self._queue.extendleft(reversed(retry[:room]))
+            self.dropped += len(retry) - min(len(retry), room)
+            return
+
+
+class TouchCoalescer(_Buffer):
+    """
+    Coalesces "last seen" timestamps: any number of touches for one key within
+    `interval` seconds become at most one write, flushed as an unordered bulk_write
+    of `$max` updates (so a late flush can never move the timestamp backwards).
+    Both the pending map and the recently-written set are bounded.
+    """
+
+    def __init__(self, collection, key_field: str, ts_field: str, interval: float,
+                 max_batch: int, flush_sec: float, max_pending: int):
+        super().__init__(max_batch, flush_sec)
+        self.collection = collection
+        self.name = f"{collection.name}.{ts_field}"
+        self.key_field = key_field
+        self.ts_field = ts_field
+        self.max_pending = int(max_pending)
+        self._pending: Dict[int, datetime] = {}
+        # Keys written within the last `interval` seconds; touches for them are skipped
+        self._recent = TTLCache(max_pending, interval)
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def touch(self, key: int, ts: Optional[datetime] = None):
+        if key in self._recent:
+            return
+        if key not in self._pending and len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            self._full.set()
+            return
+        self._pending[key] = ts or datetime.utcnow()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    async def flush(self):
+        while self._pending:
+            keys = list(self._pending)[:self.max_batch]
+            ops = [
+                UpdateOne({self.key_field: k}, {"$max": {self.ts_field: self._pending[k]}})
+                for k in keys
+            ]
+            try:
+                await self.collection.bulk_write(ops, ordered=False)
+            except Exception as e:
+                self.failures += 1
+                log.warning(f"write-behind flush of {self.name} failed ({len(ops)} keys): {e}")
+                return  # keys stay pending for the next attempt
+            for k in keys:
+                self._pending.pop(k, None)
+                self._recent.set(k, True)
+            self.written += len(ops)
+
+
+async def writebehind_worker():
+    await asyncio.gather(*(b.run() for b in _buffers))
+
+
+async def flush_all():
+    """Drain every buffer; called on shutdown."""
+    for b in _buffers:
+        try:
+            await b.flush()
+        except Exception as e:
+            log.warning(f"write-behind {b.name} final flush failed: {e}")
+
+
+def writebehind_metrics() -> Dict[str, Dict[str, int]]:
+    return {b.name: b.metrics() for b in _buffers}